@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+
+# Copyright: (c) 2024, Sören Schmidt <soeren.schmidt@suse.com>
+# GNU General Public License v3.0+ (see LICENSE or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+"""Action plugin for the `saptune` module.
+
+Hosts with the same `saptune` package version and the same Note and
+Solution definitions (see `catalog_key` of the module) have the same
+catalog. The plugin keeps the catalogs returned by the module on the
+controller for the rest of the run and hands them over to the module
+on the other hosts, which then can skip `saptune note list` and
+`saptune solution list`.
+
+Any task can change the catalog of a host (e.g. a package update or
+a copied Note definition), so a key stored by an earlier task only
+tells which catalog to hand over. Only the next items of a loop of
+the same task can rely on it: their apply list is validated on the
+controller and an invalid one fails without touching the host.
+
+The catalogs live in the local temporary directory of the Ansible run,
+so they are shared by all worker processes and removed at its end."""
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import hashlib
+import importlib.util
+import json
+import os
+import tempfile
+from typing import List, Dict, Any, Callable
+
+from ansible import constants as C
+from ansible.plugins.action import ActionBase
+from ansible.plugins.loader import module_utils_loader
+
+# Maximum number of catalogs handed over to a host, whose key is not
+# known yet. Each one adds to the arguments of the module.
+MAX_CATALOGS = 4
+
+
+def cache_directory() -> str:
+    """Returns the directory for the catalogs and host keys."""
+
+    return os.path.join(C.DEFAULT_LOCAL_TMP, 'saptune_catalogs')
+
+def catalog_path(key: Dict[str, str]) -> str:
+    """Returns the path of the catalog with the given key."""
+
+    name = hashlib.sha256(json.dumps([key['package version'], key['definitions hash']]).encode('utf-8')).hexdigest()
+    return os.path.join(cache_directory(), f'{name}.json')
+
+def host_path(host: str) -> str:
+    """Returns the path of the file with the key of the given host
+    and the task which has stored it."""
+
+    return os.path.join(cache_directory(), 'hosts', f'''{hashlib.sha256(host.encode('utf-8')).hexdigest()}.json''')
+
+def read_json(path: str) -> Any:
+    """Returns the content of the given file or None, if it does
+    not exist or cannot be read."""
+
+    try:
+        with open(path, 'r') as json_file:
+            return json.load(json_file)
+    except (OSError, ValueError):
+        return None
+
+def write_json(path: str, content: Any) -> None:
+    """Writes the content atomically to the given file, so other
+    workers never read a partial file."""
+
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=f'.{os.path.basename(path)}.')
+    try:
+        with os.fdopen(fd, 'w') as json_file:
+            json.dump(content, json_file)
+        os.replace(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
+def cached_catalogs() -> List[Dict[str, Any]]:
+    """Returns the most recently stored catalogs (at most MAX_CATALOGS)."""
+
+    try:
+        paths = [entry.path for entry in os.scandir(cache_directory()) if entry.is_file() and entry.name.endswith('.json')]
+    except OSError:
+        return []
+    paths.sort(key=lambda path: os.stat(path).st_mtime, reverse=True)
+    catalogs = [read_json(path) for path in paths[:MAX_CATALOGS]]
+    return [catalog for catalog in catalogs if catalog]
+
+def load_plan_apply() -> Callable:
+    """Returns plan_apply() of `saptune_plan.py` from the configured
+    module_utils or the `module_utils/` next to `action_plugins/`."""
+
+    path = module_utils_loader.find_plugin('saptune_plan', mod_type='.py') or \
+           os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'module_utils', 'saptune_plan.py')
+    spec = importlib.util.spec_from_file_location('saptune_plan', path)
+    saptune_plan = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(saptune_plan)
+    return saptune_plan.plan_apply
+
+
+class ActionModule(ActionBase):
+
+    TRANSFERS_FILES = False
+
+    def run(self, tmp=None, task_vars=None):
+        result = super(ActionModule, self).run(tmp, task_vars)
+        del tmp
+
+        # Without an apply list the catalog is not needed and a
+        # catalog given explicitly is left alone.
+        module_args = self._task.args.copy()
+        if 'apply' not in module_args or 'catalogs' in module_args:
+            result.update(self._execute_module(module_args=module_args, task_vars=task_vars))
+            return result
+
+        # If the catalog of the host has been stored by this task
+        # (an earlier item of a loop), it still matches and the apply
+        # list gets validated here. A key from an earlier task might
+        # be outdated, so its catalog is only handed over as a
+        # candidate and the module validates. A rollout counts staged
+        # Notes and Solutions as well, so it is left to the module.
+        catalogs = []
+        host = read_json(host_path(task_vars['inventory_hostname']))
+        catalog = read_json(catalog_path(host['catalog key'])) if host else None
+        if catalog:
+            if host['task'] == self._task._uuid and \
+               module_args.get('rollout', 'none') == 'none' and isinstance(module_args['apply'] or [], list):
+                plan = load_plan_apply()(module_args['apply'] or [], catalog['notes'], catalog['solutions'], catalog['solution_map'])
+                if plan.errors:
+                    result.update(failed=True, changed=False, msg=plan.errors[0]['msg'], apply_errors=plan.errors)
+                    return result
+            catalogs = [catalog]
+        else:
+            catalogs = cached_catalogs()
+
+        # Run the module and keep its catalog for the other hosts.
+        module_args['catalogs'] = catalogs
+        module_result = self._execute_module(module_args=module_args, task_vars=task_vars)
+        catalog = module_result.pop('catalog', None)
+        try:
+            if catalog:
+                write_json(catalog_path(catalog), catalog)
+            if module_result.get('catalog_key'):
+                write_json(host_path(task_vars['inventory_hostname']), {'catalog key': module_result['catalog_key'], 
+                                                                        'task': self._task._uuid})
+        except OSError as err:
+            self._display.warning(f'Could not store the saptune catalog on the controller: {err}')
+        result.update(module_result)
+        return result
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+"""End-to-end benchmark of the `saptune` and `saptune_facts` modules.
+
+Runs run_module() of both modules in-process against the fake 
+`saptune` and `systemctl` in `fake/` for a set of scenarios and 
+reports wall time, number of spawned processes and size of the
+module result. No real saptune is touched.
+
+    python3 benchmarks/bench.py [--repeat N] [--latency-scale F] [--scenario NAME]...
+"""
+
+import argparse
+import contextlib
+import copy
+import importlib.util
+import io
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Tuple
+
+import ansible.module_utils
+from ansible.module_utils import basic
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+LIBRARY_DIR = os.path.join(os.path.dirname(BENCHMARK_DIR), 'library')
+MODULE_UTILS_DIR = os.path.join(os.path.dirname(BENCHMARK_DIR), 'module_utils')
+FAKE_DIR = os.path.join(BENCHMARK_DIR, 'fake')
+
+# Rough latencies (seconds) of the commands on a real system. The
+# longest matching prefix is used.
+LATENCY = {
+    'saptune --format json status --non-compliance-check': 0.3,
+    'saptune --format json status': 1.5,
+    'saptune --format json note list': 0.3,
+    'saptune --format json solution list': 0.3,
+    'saptune --format json note verify': 0.4,
+    'saptune revert all': 1.0,
+    'saptune note apply': 0.5,
+    'saptune note revert': 0.3,
+    'saptune solution apply': 1.5,
+    'saptune staging': 0.2,
+    'systemctl': 0.1
+}
+
+# The state of the host before each run.
+BASE_STATE = {
+    'version': '3.1.3',
+    'systemd_state': 'running',
+    'services': {'saptune': ['enabled', 'active'], 'sapconf': [], 'tuned': ['disabled', 'inactive']},
+    'notes': ['1410736', '1656250', '1680803', '1771258', '1868829', '1980196', '2161991', '2382421', '2534844', '2578899', 
+              '2684254', '2993054', '3024346', '900929', '941735', 'SAP_BOBJ'],
+    'solutions': {'HANA': ['941735', '1771258', '1980196', '2578899', '2684254', '2382421', '2534844', '2993054', '1656250'],
+                  'NETWEAVER': ['941735', '1771258', '2578899', '2993054', '1656250', '900929'],
+                  'S4HANA-DBSERVER': ['941735', '1771258', '1980196', '2578899', '2684254', '2382421', '2534844', '2993054', '1656250']},
+    'notes_applied': ['941735', '1771258', '1980196', '2578899', '2684254', '2382421', '2534844', '2993054', '1656250', '1410736'],
+    'notes_enabled': ['941735', '1771258', '1980196', '2578899', '2684254', '2382421', '2534844', '2993054', '1656250', '1410736'],
+    'solution_applied': 'HANA',
+    'solution_enabled': 'HANA',
+    'staging': False,
+    'drift': [],
+    'latency': {}
+}
+
+# Scenarios: changes of the base state and the arguments of the
+# `saptune` module.
+SCENARIOS = {
+    'no-op': ({}, 
+              {'apply': ['@HANA', '1410736']}),
+    'note-change': ({}, 
+                    {'apply': ['@HANA', '1410736', '2161991']}),
+    'solution-switch': ({}, 
+                        {'apply': ['@NETWEAVER', '1410736']}),
+    'non-compliant': ({'drift': ['2382421']}, 
+                      {'apply': ['@HANA', '1410736']}),
+    'stopped-service': ({'services': {'saptune': ['enabled', 'inactive'], 'sapconf': [], 'tuned': ['disabled', 'inactive']},
+                         'notes_applied': [], 'solution_applied': None}, 
+                        {'apply': ['@HANA', '1410736']}),
+    'disabled-service': ({'services': {'saptune': ['disabled', 'inactive'], 'sapconf': [], 'tuned': ['disabled', 'inactive']},
+                          'notes_applied': [], 'notes_enabled': [], 'solution_applied': None, 'solution_enabled': None}, 
+                         {'apply': ['@HANA', '1410736']})
+}
+
+
+def load_module(name: str) -> Any:
+    """Imports the given module from `library/`. Its imports of
+    `ansible.module_utils` are found in `module_utils/` as well."""
+
+    if MODULE_UTILS_DIR not in ansible.module_utils.__path__:
+        ansible.module_utils.__path__.append(MODULE_UTILS_DIR)
+    spec = importlib.util.spec_from_file_location(f'bench_{name}', os.path.join(LIBRARY_DIR, f'{name}.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def run(module: Any, args: Dict[str, Any], state: Dict[str, Any], state_path: str) -> Tuple[float, int, int, Dict[str, Any]]:
+    """Resets the fake state, runs run_module() of the given module 
+    with the arguments and returns the wall time, the number of 
+    spawned processes, the result size and the result."""
+
+    with open(state_path, 'w') as state_file:
+        json.dump(state, state_file)
+    open(f'{state_path}.log', 'w').close()
+
+    basic._ANSIBLE_ARGS = json.dumps({'ANSIBLE_MODULE_ARGS': args}).encode('utf-8')
+    basic._ANSIBLE_PROFILE = 'legacy'  # required since ansible-core 2.19
+    output = io.StringIO()
+    start = time.monotonic()
+    with contextlib.redirect_stdout(output):
+        try:
+            module.run_module()
+        except SystemExit:
+            pass
+    wall_time = time.monotonic() - start
+
+    with open(f'{state_path}.log', 'r') as log_file:
+        spawns = len(log_file.readlines())
+    return wall_time, spawns, len(output.getvalue().encode('utf-8')), json.loads(output.getvalue())
+
+def main(argv: List[str]=None) -> int:
+    parser = argparse.ArgumentParser(description='Benchmark the saptune modules against a fake saptune.')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per scenario and module (default: 3)')
+    parser.add_argument('--latency-scale', type=float, default=1.0, 
+                        help='factor for the command latencies, 0 measures the module overhead only (default: 1.0)')
+    parser.add_argument('--scenario', action='append', choices=list(SCENARIOS), help='scenario to run (default: all)')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args(argv)
+
+    modules = {name: load_module(name) for name in ('saptune', 'saptune_facts')}
+    os.environ['PATH'] = f'''{FAKE_DIR}{os.pathsep}{os.environ['PATH']}'''
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        state_path = os.path.join(tmp_dir, 'state.json')
+        os.environ['FAKE_SAPTUNE_STATE'] = state_path
+        for scenario in args.scenario or SCENARIOS:
+            changes, saptune_args = SCENARIOS[scenario]
+            state = copy.deepcopy(BASE_STATE)
+            state.update(copy.deepcopy(changes))
+            state['latency'] = {prefix: latency * args.latency_scale for prefix, latency in LATENCY.items()}
+            for name, module_args in (('saptune_facts', {'cache': False}), 
+                                      ('saptune', dict(saptune_args, catalog_cache=False))):
+                module_args = dict(module_args, cache_dir=os.path.join(tmp_dir, 'cache'))
+                runs = [run(modules[name], module_args, state, state_path) for _ in range(args.repeat)]
+                failed = [result['msg'] for *_, result in runs if result.get('failed')]
+                results.append({'scenario': scenario, 
+                                'module': name,
+                                'wall_time': round(statistics.median(run[0] for run in runs), 3),
+                                'spawns': max(run[1] for run in runs),
+                                'untuned_window': round(statistics.median(result['timings'].get('untuned_window', 0) 
+                                                                          for *_, result in runs), 3),
+                                'result_size': max(run[2] for run in runs),
+                                'failed': failed[0] if failed else None})
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f'''{'scenario':<18}{'module':<15}{'wall time [s]':>14}{'untuned [s]':>12}{'spawns':>8}{'result [bytes]':>16}''')
+        for entry in results:
+            print(f'''{entry['scenario']:<18}{entry['module']:<15}{entry['wall_time']:>14.3f}{entry['untuned_window']:>12.3f}'''
+                  f'''{entry['spawns']:>8}{entry['result_size']:>16}'''
+                  + (f'''  FAILED: {entry['failed']}''' if entry['failed'] else ''))
+    return 1 if any(entry['failed'] for entry in results) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
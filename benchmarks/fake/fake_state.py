@@ -0,0 +1,44 @@
+"""State handling shared by the fake `saptune` and `systemctl`."""
+
+import json
+import os
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List
+
+
+def load_state() -> Dict[str, Any]:
+    """Returns the state from the file given by FAKE_SAPTUNE_STATE."""
+
+    with open(os.environ['FAKE_SAPTUNE_STATE'], 'r') as state_file:
+        return json.load(state_file)
+
+def save_state(state: Dict[str, Any]) -> None:
+    """Writes the state atomically, so parallel queries never
+    read a partial file."""
+
+    path = os.environ['FAKE_SAPTUNE_STATE']
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, 'w') as state_file:
+        json.dump(state, state_file)
+    os.replace(tmp_path, path)
+
+def log_call(state: Dict[str, Any], command: List[str]) -> None:
+    """Appends the command to the call log and sleeps for the
+    latency of the longest matching command prefix."""
+
+    with open(f'''{os.environ['FAKE_SAPTUNE_STATE']}.log''', 'a') as log_file:
+        log_file.write(' '.join(command) + '\n')
+    command_str = ' '.join(command)
+    prefixes = [prefix for prefix in state['latency'] if command_str.startswith(prefix)]
+    if prefixes:
+        time.sleep(state['latency'][max(prefixes, key=len)])
+
+def out(result: Dict[str, Any], returncode: int) -> int:
+    """Prints the result in the JSON format of saptune and
+    returns the exit code."""
+
+    print(json.dumps({'$schema': 'file:///usr/share/saptune/schemas/1.0/saptune_fake.schema.json', 
+                      'result': result}))
+    return returncode
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""Scaling micro-benchmark of the apply planner (module_utils/saptune_plan.py).
+
+Generates catalogs with thousands of Notes and Solutions and long
+apply lists (applies, reverts and a Solution) and measures 
+plan_apply() as well as plan_incremental() against a current 
+tuning sharing a prefix with the apply list. The time per entry
+should stay flat while the size doubles.
+
+    python3 benchmarks/plan_scaling.py [--sizes N,N,...] [--repeat N] [--seed N]
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+from typing import Dict, List, Tuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'module_utils'))
+from saptune_plan import plan_apply, plan_incremental
+
+
+def generate(size: int, rng: random.Random) -> Tuple[List[str], List[str], Dict[str, List[str]], List[str], List[str], str]:
+    """Returns a catalog (Notes, Solutions, Notes of each Solution)
+    with `size` Notes, an apply list with `size` entries and a
+    current tuning (applied Notes and Solution) which matches the
+    first half of the apply list."""
+
+    notes = [f'{3000000 + index}' for index in range(size)]
+    solutions = {f'SOLUTION_{index}': rng.sample(notes, min(size // 4, 500)) for index in range(16)}
+    solution = rng.choice(list(solutions))
+
+    apply_list = [f'@{solution}']
+    pool = [note for note in notes if note not in set(solutions[solution])]
+    while len(apply_list) < size:
+        if rng.random() < 0.2 and len(apply_list) > 1:
+            apply_list.append(f'-{rng.choice(apply_list[1:]).lstrip("-")}')
+        else:
+            apply_list.append(rng.choice(pool))
+
+    current = plan_apply(apply_list[:size // 2], notes, list(solutions), solutions)
+    return notes, list(solutions), solutions, apply_list, current.notes, current.solution
+
+def measure(function, repeat: int) -> float:
+    """Returns the fastest of `repeat` runs of the function in seconds."""
+
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+    return min(durations)
+
+def main(argv: List[str]=None) -> int:
+    parser = argparse.ArgumentParser(description='Measure how the apply planner scales.')
+    parser.add_argument('--sizes', default='1000,2000,4000,8000,16000,32000', 
+                        help='comma separated numbers of Notes and apply list entries')
+    parser.add_argument('--repeat', type=int, default=5, help='runs per size, the fastest counts (default: 5)')
+    parser.add_argument('--seed', type=int, default=42, help='seed of the generator (default: 42)')
+    args = parser.parse_args(argv)
+
+    rng = random.Random(args.seed)
+    print(f'''{'entries':>8}{'plan_apply [ms]':>18}{'per entry [us]':>16}{'plan_incremental [ms]':>23}{'per entry [us]':>16}''')
+    for size in [int(size) for size in args.sizes.split(',')]:
+        notes, solutions, solution_map, apply_list, current_notes, current_solution = generate(size, rng)
+        plan = plan_apply(apply_list, notes, solutions, solution_map)
+        if plan.errors:
+            print(f'''invalid apply list: {plan.errors[0]['msg']}''', file=sys.stderr)
+            return 1
+        apply_time = measure(lambda: plan_apply(apply_list, notes, solutions, solution_map), args.repeat)
+        incremental_time = measure(lambda: plan_incremental(plan.commands[1:], solution_map, current_notes, current_solution), args.repeat)
+        print(f'{size:>8}{apply_time * 1e3:>18.2f}{apply_time / size * 1e6:>16.2f}'
+              f'{incremental_time * 1e3:>23.2f}{incremental_time / size * 1e6:>16.2f}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""Measures the AnsiballZ payload size and the per-invocation cost of
+the `saptune` and `saptune_facts` modules.
+
+Lets Ansible build the payload (AnsiballZ wrapper with the module and
+all `module_utils` it imports) for a local run with the remote files
+kept, then executes that payload repeatedly against the fake `saptune`
+from `fake/` without latency. The interpreter startup alone
+(`python3 -c pass`) is reported for comparison.
+
+Because the import of `ansible.module_utils.basic` dominates each
+invocation, the share of the modules themselves is measured as well:
+the time to compile and load the module (with the `module_utils` it
+imports at the top) in a fresh interpreter, which has imported
+`ansible.module_utils.basic` already. Just like in the payload, no
+byte code gets cached.
+
+    python3 benchmarks/startup.py [--repeat N]
+"""
+
+import argparse
+import copy
+import glob
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+sys.path.insert(0, BENCHMARK_DIR)
+from bench import BASE_STATE, FAKE_DIR
+
+# The module runs to measure: module, arguments, check mode.
+RUNS = [
+    ('saptune_facts', {'cache': False}, False),
+    ('saptune', {'apply': ['@HANA', '1410736'], 'catalog_cache': False}, False),
+    ('saptune', {'apply': ['@HANA', '1410736', '2161991'], 'catalog_cache': False}, True)
+]
+
+
+def build_payload(module: str, args: Dict, check_mode: bool, env: Dict[str, str], tmp_dir: str) -> str:
+    """Runs the module once with Ansible, keeping the remote files,
+    and returns the path of the AnsiballZ payload."""
+
+    remote_tmp = tempfile.mkdtemp(dir=tmp_dir)
+    command = ['ansible', 'localhost', '-c', 'local', '-m', module, '-a', json.dumps(args)] + (['--check'] if check_mode else [])
+    subprocess.run(command, env=dict(env, ANSIBLE_KEEP_REMOTE_FILES='1', ANSIBLE_REMOTE_TMP=remote_tmp), 
+                   check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return glob.glob(os.path.join(remote_tmp, '*', f'AnsiballZ_{module}.py'))[0]
+
+# Loads the module given as first argument like AnsiballZ does and
+# prints the duration in seconds.
+LOAD_SCRIPT = '''
+import sys, time, ansible.module_utils, ansible.module_utils.basic
+ansible.module_utils.__path__.append(sys.argv[2])
+start = time.perf_counter()
+with open(sys.argv[1]) as module_file:
+    exec(compile(module_file.read(), sys.argv[1], 'exec'), {'__name__': 'module'})
+print(time.perf_counter() - start)
+'''
+
+
+def measure_load(module: str, env: Dict[str, str], repeat: int) -> List[float]:
+    """Returns the durations of `repeat` loads of the module without
+    the import of `ansible.module_utils.basic`."""
+
+    command = [sys.executable, '-B', '-c', LOAD_SCRIPT, os.path.join(REPO_DIR, 'library', f'{module}.py'), 
+               os.path.join(REPO_DIR, 'module_utils')]
+    with tempfile.TemporaryDirectory() as pycache_dir:
+        # An empty byte code cache, so existing `__pycache__` is ignored.
+        env = dict(env, PYTHONPYCACHEPREFIX=pycache_dir)
+        return [float(subprocess.run(command, env=env, check=True, capture_output=True, text=True).stdout) 
+                for _ in range(repeat)]
+
+def measure(command: List[str], env: Dict[str, str], repeat: int) -> List[float]:
+    """Returns the wall times of `repeat` runs of the command."""
+
+    durations = []
+    for _ in range(repeat):
+        start = time.monotonic()
+        subprocess.run(command, env=env, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        durations.append(time.monotonic() - start)
+    return durations
+
+def main(argv: List[str]=None) -> int:
+    parser = argparse.ArgumentParser(description='Measure payload size and invocation cost of the saptune modules.')
+    parser.add_argument('--repeat', type=int, default=20, help='invocations per module run (default: 20)')
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        state_path = os.path.join(tmp_dir, 'state.json')
+        env = dict(os.environ, 
+                   PATH=f'''{FAKE_DIR}{os.pathsep}{os.environ['PATH']}''',
+                   FAKE_SAPTUNE_STATE=state_path,
+                   ANSIBLE_LIBRARY=os.path.join(REPO_DIR, 'library'),
+                   ANSIBLE_MODULE_UTILS=os.path.join(REPO_DIR, 'module_utils'),
+                   ANSIBLE_LOCALHOST_WARNING='false',
+                   ANSIBLE_INVENTORY_UNPARSED_WARNING='false')
+
+        def reset_state() -> None:
+            state = copy.deepcopy(BASE_STATE)
+            with open(state_path, 'w') as state_file:
+                json.dump(state, state_file)
+
+        reset_state()
+        baseline = measure([sys.executable, '-c', 'pass'], env, args.repeat)
+        print(f'''{'module':<15}{'check':>6}{'payload [bytes]':>17}{'median [ms]':>13}{'min [ms]':>10}{'load [ms]':>11}''')
+        print(f'''{'python3 -c pass':<15}{'':>6}{'':>17}{statistics.median(baseline) * 1e3:>13.1f}{min(baseline) * 1e3:>10.1f}''')
+        for module, module_args, check_mode in RUNS:
+            reset_state()
+            payload = build_payload(module, module_args, check_mode, env, tmp_dir)
+            durations = []
+            for _ in range(args.repeat):
+                reset_state()
+                durations.extend(measure([sys.executable, payload], env, 1))
+            load = measure_load(module, env, args.repeat)
+            print(f'''{module:<15}{'yes' if check_mode else 'no':>6}{os.path.getsize(payload):>17}'''
+                  f'''{statistics.median(durations) * 1e3:>13.1f}{min(durations) * 1e3:>10.1f}{statistics.median(load) * 1e3:>11.1f}''')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
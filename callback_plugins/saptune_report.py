@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+
+# Copyright: (c) 2024, Sören Schmidt <soeren.schmidt@suse.com>
+# GNU General Public License v3.0+ (see LICENSE or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+DOCUMENTATION = r'''
+---
+name: saptune_report
+type: aggregate
+short_description: Aggregates the saptune status of all hosts into a report
+description:
+    - Consumes the results of the C(saptune_facts) and C(saptune) tasks as they arrive and keeps a compact
+      aggregate for each task, instead of collecting the status of each host.
+    - Counts hosts per package version, applied Solution, set of applied Notes, tuning state and state of
+      each service and samples outlier hosts (failed, unreachable, non-compliant, degraded, C(saptune.service)
+      not active, C(tuned.service) or C(sapconf.service) active).
+    - Each item of a loop counts as a result of its own, outlier hosts are listed together with the item then.
+    - The aggregate is written to O(json_path) after every O(write_interval) results and at the end of the run.
+      If O(csv_path) is set, a line per host and task is appended there right away.
+    - The memory used does not depend on the number of hosts, only on O(max_keys) and O(max_outliers).
+requirements:
+    - enable in configuration (C(callbacks_enabled = saptune_report))
+options:
+    json_path:
+        description: File the aggregate is written to in JSON.
+        type: path
+        default: saptune_report.json
+        ini:
+            - section: callback_saptune_report
+              key: json_path
+        env:
+            - name: SAPTUNE_REPORT_JSON_PATH
+    csv_path:
+        description: If set, a line for each host and task is appended to this CSV file.
+        type: path
+        ini:
+            - section: callback_saptune_report
+              key: csv_path
+        env:
+            - name: SAPTUNE_REPORT_CSV_PATH
+    write_interval:
+        description: Number of results after which the aggregate is written again.
+        type: int
+        default: 100
+        ini:
+            - section: callback_saptune_report
+              key: write_interval
+        env:
+            - name: SAPTUNE_REPORT_WRITE_INTERVAL
+    max_keys:
+        description:
+            Maximum number of different values counted per category (e.g. sets of applied Notes).
+            Further values are counted as C((other)).
+        type: int
+        default: 50
+        ini:
+            - section: callback_saptune_report
+              key: max_keys
+        env:
+            - name: SAPTUNE_REPORT_MAX_KEYS
+    max_outliers:
+        description: Maximum number of hosts listed per outlier category. All of them are counted.
+        type: int
+        default: 20
+        ini:
+            - section: callback_saptune_report
+              key: max_outliers
+        env:
+            - name: SAPTUNE_REPORT_MAX_OUTLIERS
+'''
+
+import csv
+import json
+import os
+import tempfile
+import time
+from typing import Dict, Any
+
+from ansible.plugins.callback import CallbackBase
+
+# The modules whose results are aggregated.
+MODULES = ('saptune', 'saptune_facts')
+
+# The columns of the CSV file.
+CSV_COLUMNS = ['timestamp', 'task', 'host', 'item', 'result', 'package version', 'Solution applied', 'Notes applied',
+               'tuning state', 'systemd system state', 'saptune.service', 'tuned.service', 'sapconf.service']
+
+
+def new_aggregate(task_name: str, module_name: str) -> Dict[str, Any]:
+    """Returns an empty aggregate for a task."""
+
+    return {'task': task_name,
+            'module': module_name,
+            'hosts': 0,
+            'results': {},
+            'package version': {},
+            'Solution applied': {},
+            'Notes applied': {},
+            'tuning state': {},
+            'services': {},
+            'outliers': {}}
+
+def get_status(module_name: str, module_result: Dict[str, Any]) -> Dict[str, Any]:
+    """Returns the saptune status of the given module result or an
+    empty dict."""
+
+    if module_name == 'saptune_facts':
+        return module_result.get('ansible_facts', {}).get('saptune') or {}
+    return module_result.get('saptune_status') or {}
+
+
+class CallbackModule(CallbackBase):
+
+    CALLBACK_VERSION = 2.0
+    CALLBACK_TYPE = 'aggregate'
+    CALLBACK_NAME = 'saptune_report'
+    CALLBACK_NEEDS_ENABLED = True
+
+    def __init__(self, *args, **kwargs):
+        super(CallbackModule, self).__init__(*args, **kwargs)
+        self.aggregates = {}    # per task, in the order of the tasks
+        self.pending = 0        # results not written yet
+        self.csv_file = None
+        self.csv_writer = None
+
+    def count(self, counter: Dict[str, int], key: str) -> None:
+        """Counts the key, as long as no more than `max_keys` keys
+        are counted, otherwise `(other)`."""
+
+        if key not in counter and len(counter) >= self.get_option('max_keys'):
+            key = '(other)'
+        counter[key] = counter.get(key, 0) + 1
+
+    def add_outlier(self, aggregate: Dict[str, Any], category: str, host: str) -> None:
+        """Counts the host as outlier of the category and lists it,
+        as long as no more than `max_outliers` are listed."""
+
+        outliers = aggregate['outliers'].setdefault(category, {'count': 0, 'hosts': []})
+        outliers['count'] += 1
+        if len(outliers['hosts']) < self.get_option('max_outliers'):
+            outliers['hosts'].append(host)
+
+    def add_result(self, result: Any, outcome: str, is_item: bool=False) -> None:
+        """Adds the result of a `saptune` or `saptune_facts` task (or
+        of one item of its loop) to the aggregate of the task and the
+        CSV file. The overall result of a loop is skipped, its items
+        have been added already."""
+
+        task = getattr(result, 'task', None) or result._task
+        module_name = task.action.rsplit('.', 1)[-1]
+        if module_name not in MODULES:
+            return
+        module_result = getattr(result, 'result', None) or result._result
+        if not is_item and 'results' in module_result:
+            return
+        host = (getattr(result, 'host', None) or result._host).get_name()
+        item = str(self._get_item_label(module_result)) if is_item else ''
+        host_label = f'{host} ({item})' if item else host
+        aggregate = self.aggregates.setdefault(task._uuid, new_aggregate(task.get_name(), module_name))
+        status = get_status(module_name, module_result)
+
+        aggregate['hosts'] += 1
+        self.count(aggregate['results'], outcome)
+        if outcome != 'ok':
+            self.add_outlier(aggregate, outcome, host_label)
+        services = status.get('services', {})
+        if status:
+            applied_solution = status['Solution applied'][0]['Solution ID'] if status.get('Solution applied') else '(none)'
+            self.count(aggregate['package version'], status.get('package version', '(unknown)'))
+            self.count(aggregate['Solution applied'], applied_solution)
+            self.count(aggregate['Notes applied'], ' '.join(status.get('Notes applied', [])) or '(none)')
+            self.count(aggregate['tuning state'], status.get('tuning state', '(not checked)'))
+            for service, states in services.items():
+                self.count(aggregate['services'].setdefault(f'{service}.service', {}), '/'.join(states) or '(not installed)')
+            if status.get('tuning state') == 'not compliant':
+                self.add_outlier(aggregate, 'not compliant', host_label)
+            if status.get('systemd system state') == 'degraded':
+                self.add_outlier(aggregate, 'degraded', host_label)
+            if services.get('saptune') and services['saptune'][1] != 'active':
+                self.add_outlier(aggregate, 'saptune.service not active', host_label)
+            for service in ('tuned', 'sapconf'):
+                if services.get(service) and services[service][1] == 'active':
+                    self.add_outlier(aggregate, f'{service}.service active', host_label)
+
+        if self.get_option('csv_path'):
+            self.write_csv_line([round(time.time(), 3), aggregate['task'], host, item, outcome,
+                                 status.get('package version', ''),
+                                 status['Solution applied'][0]['Solution ID'] if status.get('Solution applied') else '',
+                                 ' '.join(status.get('Notes applied', [])),
+                                 status.get('tuning state', ''),
+                                 status.get('systemd system state', '')] +
+                                ['/'.join(services.get(service, [])) for service in ('saptune', 'tuned', 'sapconf')])
+
+        self.pending += 1
+        if self.pending >= self.get_option('write_interval'):
+            self.write_json()
+
+    def write_csv_line(self, line: list) -> None:
+        """Appends the line to the CSV file (with a header, if the
+        file is new) and flushes it. A failure only results in a
+        warning and stops the CSV file."""
+
+        try:
+            if self.csv_writer is None:
+                path = self.get_option('csv_path')
+                new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+                self.csv_file = open(path, 'a', newline='')
+                self.csv_writer = csv.writer(self.csv_file)
+                if new_file:
+                    self.csv_writer.writerow(CSV_COLUMNS)
+            self.csv_writer.writerow(line)
+            self.csv_file.flush()
+        except OSError as err:
+            self._display.warning(f'Could not write saptune report {self.get_option("csv_path")}: {err}')
+            self.set_option('csv_path', None)
+
+    def write_json(self) -> None:
+        """Writes the aggregates atomically to the JSON file. A failure
+        only results in a warning."""
+
+        path = self.get_option('json_path')
+        self.pending = 0
+        try:
+            directory = os.path.dirname(os.path.abspath(path))
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f'.{os.path.basename(path)}.')
+            try:
+                with os.fdopen(fd, 'w') as json_file:
+                    json.dump({'timestamp': round(time.time(), 3), 'tasks': list(self.aggregates.values())}, json_file, indent=2)
+                os.replace(tmp_path, path)
+            except Exception:
+                os.unlink(tmp_path)
+                raise
+        except OSError as err:
+            self._display.warning(f'Could not write saptune report {path}: {err}')
+
+    def v2_runner_on_ok(self, result):
+        self.add_result(result, 'ok')
+
+    def v2_runner_on_failed(self, result, ignore_errors=False):
+        self.add_result(result, 'failed')
+
+    def v2_runner_on_unreachable(self, result):
+        self.add_result(result, 'unreachable')
+
+    def v2_runner_item_on_ok(self, result):
+        self.add_result(result, 'ok', is_item=True)
+
+    def v2_runner_item_on_failed(self, result):
+        self.add_result(result, 'failed', is_item=True)
+
+    def v2_playbook_on_stats(self, stats):
+        if self.aggregates:
+            self.write_json()
+        if self.csv_file is not None:
+            self.csv_file.close()
+            self.csv_file = None
+            self.csv_writer = None
@@ -28,7 +28,7 @@ options:
         description:
             List of Notes or a Solution which shall be applied
             in this order. No optimization is done to remove
-            unnecessary applies or reverts. 
+            unnecessary applies or reverts (see O(incremental)). 
             Only one Solution is allowed and must start with C(@).
             Notes can be prefixed by C(-) to revert it.
             If O(apply) is missing, the tuning will be left alone.
@@ -44,6 +44,77 @@ options:
         required: false
         default: false
         type: bool
+    incremental:
+        description:
+            Defines if the tuning shall be changed incrementally.
+            Instead of starting with C(saptune revert all), only the
+            Notes which are not part of the requested tuning get reverted
+            and only the missing part of the apply list gets applied.
+            If the order of the applied Notes cannot be preserved
+            this way, the module falls back to C(saptune revert all).
+        required: false
+        default: false
+        type: bool
+    rollout:
+        description:
+            Splits a change of the tuning into two runs using the staging of saptune (requires O(staging_enabled)).
+            With C(prepare) only the staging gets enabled, O(apply) gets validated against the available and the
+            staged Notes and Solutions, and the staged ones it refers to are recorded in O(cache_dir).
+            The release run gets planned as well and recorded together with the status and the catalog.
+            The tuning is left untouched, so this can run outside of a change window.
+            With C(release) the recorded Notes and Solutions, which are still staged, are released with a single
+            C(saptune staging release) and the tuning gets applied. Released Notes and Solutions, which are
+            applied already, get applied again with their new definition. If the host has not changed since the
+            C(prepare) run and the other parameters are the same, the recorded plan is used without querying
+            saptune first, otherwise the tuning gets planned as usual. A preceding C(prepare) run with the
+            same O(apply) is required. Combine it with O(incremental), so the release run only applies the
+            changed Notes instead of reverting and applying everything. C(none) does not use staging for the tuning.
+        required: false
+        default: none
+        choices: [ none, prepare, release ]
+        type: str
+    repair_non_compliant:
+        description:
+            Defines if a non-compliant tuning, which otherwise matches
+            the requested one, shall be repaired instead of re-applied.
+            The applied Notes get verified (C(saptune note verify)) and only
+            the non-compliant ones get reverted and applied again. Notes which
+            cannot be repaired for less anyway (e.g. Notes of the Solution applied
+            first) are only verified, if one of the others is non-compliant. To keep 
+            the order, Notes applied after them are re-applied as well.
+            If nothing can be saved this way, the module falls back to
+            C(saptune revert all).
+            Only the repaired Notes are verified afterwards.
+        required: false
+        default: false
+        type: bool
+    rollback_on_failure:
+        description:
+            Defines if the state from before the changes (applied and enabled Solution and Notes in order,
+            staging and the states of C(saptune.service), C(tuned.service) and C(sapconf.service)) shall be
+            restored, if executing the commands or the final checks fail. The module fails nevertheless and
+            reports the rollback in RV(rollback). The rollback is not limited by O(module_timeout), only
+            by O(command_timeout). Releasing staged Notes and Solutions (O(rollout=release)) is not rolled back.
+        required: false
+        default: false
+        type: bool
+    journal:
+        description:
+            Defines if the planned commands and each finished one are recorded in a journal in O(cache_dir),
+            which is synced to disk after each step. If a run gets interrupted (connection lost, module killed,
+            failed command), the next run with the same parameters resumes the tuning at the first unfinished
+            command, as long as the applied Notes and Solution still are the ones expected at that point. The
+            other commands (staging and services) are planned again for the current state. Otherwise the
+            journal is discarded with a warning and the changes are planned from scratch.
+        required: false
+        default: true
+        type: bool
+    verify_workers:
+        description:
+            Maximum number of C(saptune note verify) running in parallel.
+        required: false
+        default: 4
+        type: int
     no_tuned:
         description:
             Defines if C(tuned.service) should be stopped and disabled.
@@ -103,6 +174,90 @@ options:
         required: false
         default: false
         type: bool
+    catalog_cache:
+        description:
+            Defines if the list of available Notes and Solutions 
+            shall be cached on the host in O(cache_dir).
+            The cache is invalidated automatically if the C(saptune)
+            package version or the content of C(/usr/share/saptune),
+            C(/etc/saptune) or C(/var/lib/saptune/working) changes.
+            Set it to false to bypass the cache.
+        required: false
+        default: true
+        type: bool
+    catalogs:
+        description:
+            Catalogs (available Notes and Solutions and the Notes of each Solution) retrieved on other
+            hosts, each with the C(package version) and the C(definitions hash) (see RV(catalog_key)) of
+            the host it comes from. A catalog matching the host is used instead of calling
+            C(saptune note list) and C(saptune solution list). If set (even to an empty list), the
+            module returns RV(catalog_key) and, if no catalog has matched, the own one in RV(catalog).
+            This is set by the C(saptune) action plugin, which shares the catalogs between the hosts
+            of a play.
+        required: false
+        type: list
+        elements: dict
+    cache_dir:
+        description:
+            Directory on the host for the cache files.
+        required: false
+        default: /var/cache/ansible_saptune
+        type: path
+    status:
+        description:
+            A status previously gathered by C(saptune_facts) (C(ansible_facts.saptune)).
+            It is used instead of calling C(saptune status) at the beginning, 
+            if O(status_token) still matches the state of the host.
+            Keep in mind, that a change of the compliance which does not alter
+            the saptune configuration or state files cannot be detected.
+        required: false
+        type: dict
+    status_token:
+        description:
+            The state token returned by C(saptune_facts) together with 
+            O(status) (C(ansible_facts.saptune_state_token)).
+        required: false
+        type: str
+    command_timeout:
+        description:
+            Maximum time in seconds a single command may run. If it takes
+            longer, its process group gets terminated and the module fails.
+            C(0) means no limit.
+        required: false
+        default: 600
+        type: int
+    module_timeout:
+        description:
+            Maximum time in seconds for all commands of the module together.
+            No command runs beyond this deadline. C(0) means no limit.
+        required: false
+        default: 0
+        type: int
+    output_capture:
+        description:
+            Defines how much output of the executed commands is returned in
+            RV(command_output). C(full) keeps all lines, C(truncated) only the first
+            and last O(output_lines) lines and C(summary) only the number of lines.
+            The output of queries parsed by the module (like C(saptune status)) is never kept.
+        required: false
+        default: truncated
+        choices: [ full, truncated, summary ]
+        type: str
+    output_lines:
+        description:
+            Number of lines kept from the start and from the end of the output
+            of each command if O(output_capture=truncated).
+        required: false
+        default: 10
+        type: int
+    metrics_file:
+        description:
+            If set, the tuning state (applied Notes and Solution, compliance of the tuning and of the
+            verified Notes, service states) and the timings of the run are written atomically to this
+            file for the textfile collector of the Prometheus C(node_exporter).
+            A failure to write the file only results in a warning.
+        required: false
+        type: path
         
 requirements:
     - C(saptune) must support JSON output (>= 3.1)
@@ -128,6 +283,17 @@ EXAMPLES = r'''
 - name: Set HANA solution
   saptune:
     staging_enabled: true
+
+# Reuse the status gathered by saptune_facts
+- name: Gather saptune facts
+  saptune_facts:
+
+- name: Tune for SAP HANA
+  saptune:
+    apply:
+      - '@HANA'
+    status: '{{ ansible_facts.saptune }}'
+    status_token: '{{ ansible_facts.saptune_state_token }}'
 '''
 
 RETURN = r'''
@@ -137,6 +303,105 @@ commands:
     elements: str
     returned: success
     sample: '["saptune revert all"]'
+command_output:
+    description:
+        Exit code and output of each executed command, keyed by the command. Repeated commands
+        get a counter appended. The stdout of queries parsed by the module (like C(saptune status))
+        is not kept, such queries are only listed if they wrote to stderr or failed. How much output
+        is kept depends on O(output_capture).
+    type: dict
+    returned: if a command has been executed
+    sample: '{
+        "saptune revert all": {"rc": 0, "stdout_lines": [], "stderr_lines": []},
+        "saptune note apply 1410736": {"rc": 0, "stdout_lines": ["..."], "stderr_lines": []}
+        }'
+timings:
+    description:
+        Durations in seconds measured with a monotonic clock. C(phases) contains the duration of
+        each phase of the run (C(discovery) of status and catalog, C(planning), C(execution) of the
+        commands and C(verification) of the final status), C(commands) the duration of each executed
+        command (keyed as in RV(command_output)), C(spawns) the number of started processes and
+        C(total) the duration of the whole run. Phases not reached are missing. If the tuning has been
+        changed, C(untuned_window) is the time from the start of the first to the end of the last
+        tuning command (revert, apply, start or stop of C(saptune.service)), during which the system
+        is not tuned as desired.
+    type: dict
+    returned: always
+    sample: '{
+        "phases": {"discovery": 0.512, "planning": 0.003, "execution": 4.201, "verification": 0.498},
+        "commands": {"saptune --format json status": 0.497, "saptune note apply 1410736": 4.201},
+        "spawns": 5,
+        "untuned_window": 4.201,
+        "total": 5.214
+        }'
+apply_errors:
+    description:
+        All invalid entries of O(apply) with their position (C(index)), the C(entry) and the error
+        message (C(msg)). The module fails with the first one.
+    type: list
+    elements: dict
+    returned: if O(apply) contains invalid entries
+    sample: '[{"index": 1, "entry": "@FOO", "msg": "Solution ''FOO'' is unknown!"}]'
+release:
+    description: Staged Notes and Solutions, which are released by O(rollout=release) or will be released after O(rollout=prepare).
+    type: list
+    elements: str
+    returned: if O(rollout) is C(prepare) or C(release)
+    sample: '["1410736", "HANA"]'
+prepared:
+    description: 
+        Set, if the status, catalog and commands planned by O(rollout=prepare) have been used, because the
+        host has not changed since.
+    type: bool
+    returned: if O(rollout) is C(release) and the prepared plan has been used
+    sample: true
+catalog_key:
+    description:
+        The C(package version) of C(saptune) and a hash over the files in C(/etc/saptune/extra) and
+        C(/var/lib/saptune/working) (C(definitions hash)). Hosts with the same key have the same catalog.
+    type: dict
+    returned: if O(catalogs) is set and the catalog is needed
+    sample: '{"package version": "3.1.3", "definitions hash": "9f86d081884c7d659a2feaa0c55ad015..."}'
+catalog:
+    description:
+        The catalog of the host with its key (see RV(catalog_key)) for other hosts. The C(saptune) action
+        plugin removes it from the result.
+    type: dict
+    returned: if O(catalogs) is set, the catalog is needed and none of O(catalogs) matched
+    sample: '{"package version": "3.1.3", "definitions hash": "9f86d081884c7d659a2feaa0c55ad015...",
+              "notes": ["1410736", "1680803"], "solutions": ["HANA"], "solution_map": {"HANA": ["1680803"]}}'
+resumed:
+    description:
+        The C(step) (number of commands already executed) at which the run resumed the journal of an
+        interrupted run (see O(journal)) and the number of C(steps) of it. RV(commands) only lists the
+        remaining tuning commands and the other commands planned again for the current state.
+    type: dict
+    returned: if the journal of an interrupted run has been resumed
+    sample: '{"step": 3, "steps": 5}'
+rollback:
+    description:
+        Rollback after a failure (see O(rollback_on_failure)) with the failure message (C(reason)), the state
+        before the changes (C(snapshot)), the executed C(commands), the C(outcome) (C(restored), C(incomplete) or
+        C(failed)), the parts of the snapshot which still differ (C(differences)), the C(error) which stopped the
+        rollback and its C(duration) in seconds.
+    type: dict
+    returned: if a rollback has been done
+    sample: '{
+        "reason": "Execution of ''saptune note apply 1680803'' failed!",
+        "snapshot": {"solution_applied": null, "notes_applied": ["1410736"], "solution_enabled": null,
+                     "notes_enabled": ["1410736"], "staging_enabled": false,
+                     "services": {"saptune": ["enabled", "active"], "sapconf": [], "tuned": []}},
+        "commands": ["saptune revert all", "saptune note apply 1410736"],
+        "differences": [],
+        "outcome": "restored",
+        "duration": 1.532
+        }'
+repaired_notes:
+    description: List of Notes, which are re-applied to repair a non-compliant tuning (see O(repair_non_compliant)).
+    type: list
+    elements: str
+    returned: if a repair has been planned
+    sample: '["1410736", "1680803"]'
 saptune_status:
     description: The result object of the last C(saptune --format json status) executed by the module.
     type: dict
@@ -175,109 +440,177 @@ saptune_status:
         }'
 '''
 
-import collections
+import hashlib
 import json
-import subprocess
-from typing import List, Dict, Tuple, Any
+import os
+import time
+from typing import List, Dict, Tuple, Any, Callable
 from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.saptune_exec import setup, execute, execute_concurrently, execute_window, record_phase, set_failure_handler, HandlerFailure
+from ansible.module_utils.saptune_status import status_command, parse_status, get_note_compliance, state_fingerprint, read_cache, write_cache
 
 
-class OrderedSet():
-    """Limited implementation of an ordered set."""
-      
-    def __init__(self, iterable=[]):
-        self.ordered_set = collections.OrderedDict()
-        self.update(iterable)
-      
-    def update(self, iterable=[]):
-        for elem in iterable:
-            self.add(elem)
+# The directories which define the available Notes and Solutions.
+CATALOG_DIRECTORIES = ['/usr/share/saptune', '/etc/saptune', '/var/lib/saptune/working']
 
-    def add(self, elem):
-        self.ordered_set[elem] = None
+# The directories with host specific Note and Solution definitions.
+# Everything else of the catalog comes with the package.
+DEFINITION_DIRECTORIES = ['/etc/saptune/extra', '/var/lib/saptune/working']
 
-    def discard(self, elem):
-        self.ordered_set.pop(elem, None)  
-        
-    def intersection(self, iterable=[]):
-        intersection = OrderedSet()
-        for elem in iterable:
-            if elem in self.ordered_set.keys():
-                intersection.add(elem)
-        return intersection
-    
-    def __iter__(self):
-        yield from self.ordered_set.keys()
-    
-    def __repr__(self):
-        return self.__str__
+# The status entries the module works with.
+STATUS_KEYS = ['services', 'staging', 'package version', 'systemd system state', 
+               'Notes applied', 'Solution applied', 'Notes enabled', 'Solution enabled']
+
+# The parameters a journal has to match to be resumed.
+JOURNAL_PARAMS = ['apply', 'force_reapply', 'incremental', 'repair_non_compliant', 'no_tuned', 'no_sapconf',
+                  'enabled', 'started', 'keep_applied_if_stopped', 'ignore_non_compliant', 'staging_enabled']
 
-    def __str__(self):
-        return f'''{{{', '.join([repr(x) for x in self.ordered_set.keys()])}}}'''
+# The value of the `module` label of the run metrics.
+MODULE_NAME = 'saptune'
 
-def execute(command: List[str], ignore_error: bool=False) -> None:
-    """Executes the given command and returns stdout.
-    If ignore_error is set, an exit code not 0 does not lead to a failure.
+NOTE_LIST_COMMAND = ['saptune', '--format', 'json', 'note', 'list']
+SOLUTION_LIST_COMMAND = ['saptune', '--format', 'json', 'solution', 'list']
+
+def get_status_and_catalog(compliance_check: bool=True, with_catalog: bool=True, status: Dict[str, Any]=None, refresh: bool=False) -> Tuple[Dict[str, Any], Tuple[List[str], List[str], Dict[str, List[str]]]]:
+    """Returns 'saptune status' and, if `with_catalog` is set,
+    the present Notes and Solutions as well as the Notes of 
+    each Solution (see get_notes_and_solutions()).
+    The required saptune calls are done in parallel.
+    If `status` is given, it is used instead of calling 'saptune status'.
+    
+    If `catalog_cache` is set and the catalog directories have
+    not changed, only the status is retrieved and the cached catalog
+    is used, as long as the package version still matches.
+    If `refresh` is set, the cached catalog is not used, but 
+    rewritten.
+    Catalogs handed over by the controller (`catalogs`) can only match
+    if their definitions hash matches the local one. Otherwise the
+    lists are retrieved together with the status right away.
     Calls module.fail_json() in case of an error."""
 
-    # Set some result entries.
-    for entry, default in ('stdout', ''), ('stdout_lines', []), ('stderr', ''), ('stderr_lines', []):
-        if entry not in result:
-            result[entry] = default
-        
-    try:
-        with subprocess.Popen(command,
-                              stdout = subprocess.PIPE, 
-                              stderr = subprocess.PIPE
-                             ) as proc:
-            stdout = proc.stdout.readlines()
-            stderr = proc.stderr.readlines()
-            stdout_str = '\n'.join([line.strip().decode('utf-8') for line in stdout])
-            stderr_str = '\n'.join([line.strip().decode('utf-8') for line in stderr])
-            if stdout:
-                result['stdout'] = result['stdout'] + stdout_str 
-                result['stdout_lines'].append(stdout)
-            if stderr:
-                result['stderr'] = result['stderr'] + stderr_str
-                result['stderr_lines'].append(stderr)
-            result['rc'] = proc.returncode
-        if proc.returncode != 0 and not ignore_error:
-            module.fail_json(msg=f'''Execution of \'{' '.join(command)}\' failed!''', **result)             
-    except Exception as err:
-        module.fail_json(msg=f'''Error executing \'{' '.join(command)}\': {err}''', **result)          
-    return stdout_str
-
-def get_notes_and_solutions() -> (List[str], List[str], Dict[str, List[str]]):
-    """Calls 'saptune note list' and 'saptune solution list'
-    to get a list of all present Notes and Solutions as 
+    cache = None
+    candidates = module.params['catalogs'] if with_catalog and not refresh else None
+    definitions = definitions_hash() if with_catalog and module.params['catalogs'] is not None else None
+    commands = [(status_command(compliance_check), True)] if status is None else []
+    if with_catalog:
+        if module.params['catalog_cache'] and not refresh:
+            cache = read_cache('catalog.json')
+            if not cache or cache.get('fingerprint') != catalog_fingerprint():
+                cache = None
+        if not cache and not any(candidate.get('definitions hash') == definitions for candidate in candidates or []):
+            commands.extend([(NOTE_LIST_COMMAND, False), (SOLUTION_LIST_COMMAND, False)])
+    outputs = execute_concurrently(commands) if commands else []
+    if status is None:
+        status = get_status(compliance_check, output=outputs.pop(0))
+    else:
+        result['saptune_status'] = status
+    if not with_catalog:
+        return status, None
+
+    # A catalog handed over by the controller is used, if it has 
+    # been retrieved from a host with the same package version and
+    # Note and Solution definitions.
+    if module.params['catalogs'] is not None:
+        key = {'package version': status['package version'], 'definitions hash': definitions}
+        result['catalog_key'] = key
+        for candidate in candidates or []:
+            if all(candidate.get(name) == value for name, value in key.items()):
+                return status, (candidate['notes'], candidate['solutions'], candidate['solution_map'])
+
+    # The cached catalog is only valid for the same package version.
+    if cache and cache.get('package version') == status['package version']:
+        catalog = (cache['notes'], cache['solutions'], cache['solution_map'])
+    else:
+        if not outputs:
+            outputs.extend(execute_concurrently([(NOTE_LIST_COMMAND, False), (SOLUTION_LIST_COMMAND, False)]))
+        catalog = get_notes_and_solutions(outputs[0], outputs[1])
+        if module.params['catalog_cache'] and not module.check_mode:
+            write_cache('catalog.json', {'fingerprint': catalog_fingerprint(),
+                                         'package version': status['package version'],
+                                         'notes': catalog[0],
+                                         'solutions': catalog[1],
+                                         'solution_map': catalog[2]})
+
+    # Hand the catalog over to the controller for the other hosts.
+    if module.params['catalogs'] is not None:
+        result['catalog'] = dict(result['catalog_key'], notes=catalog[0], solutions=catalog[1], solution_map=catalog[2])
+    return status, catalog
+
+def get_notes_and_solutions(note_output: str, solution_output: str) -> (List[str], List[str], Dict[str, List[str]]):
+    """Takes the output of 'saptune note list' and 'saptune solution list'
+    and returns a list of all present Notes and Solutions as 
     well as the Notes of each Solution.
     Calls module.fail_json() in case of an error."""
 
-    result = json.loads(execute(['saptune', '--format', 'json', 'note', 'list']))
-    existing_notes = [e['Note ID'] for e in result['result']['Notes available']]
-    result = json.loads(execute(['saptune', '--format', 'json', 'solution', 'list']))
-    existing_solutions = [e['Solution ID'] for e in result['result']['Solutions available']]
-    solution_map = {e['Solution ID']: e['Note list'] for e in result['result']['Solutions available']}
+    try:
+        result_notes = json.loads(note_output)
+        existing_notes = [e['Note ID'] for e in result_notes['result']['Notes available']]
+    except (ValueError, KeyError, TypeError):
+        module.fail_json(msg=f'''No or broken JSON output of \'{' '.join(NOTE_LIST_COMMAND)}\'!''', **result)
+    try:
+        result_solutions = json.loads(solution_output)
+        existing_solutions = [e['Solution ID'] for e in result_solutions['result']['Solutions available']]
+        solution_map = {e['Solution ID']: e['Note list'] for e in result_solutions['result']['Solutions available']}
+    except (ValueError, KeyError, TypeError):
+        module.fail_json(msg=f'''No or broken JSON output of \'{' '.join(SOLUTION_LIST_COMMAND)}\'!''', **result)
 
     return existing_notes, existing_solutions, solution_map
 
-def get_status(compliance_check=True) -> Dict[str, Any]:
+def definitions_hash() -> str:
+    """Returns a hash over the paths and contents of all files in
+    the directories with host specific Note and Solution definitions.
+    Unlike catalog_fingerprint() it is the same on all hosts with
+    the same definitions."""
+
+    digest = hashlib.sha256()
+    for directory in DEFINITION_DIRECTORIES:
+        for root, dirs, files in os.walk(directory):
+            dirs.sort()
+            for path in [os.path.join(root, name) for name in sorted(files)]:
+                digest.update(f'{path}\n'.encode('utf-8'))
+                try:
+                    with open(path, 'rb') as definition:
+                        digest.update(hashlib.sha256(definition.read()).digest())
+                except OSError:
+                    digest.update(b'-')
+    return digest.hexdigest()
+
+def catalog_fingerprint() -> str:
+    """Returns a hash over the paths, modification times and 
+    sizes of everything in the catalog directories."""
+
+    digest = hashlib.sha256()
+    for directory in CATALOG_DIRECTORIES:
+        for root, dirs, files in os.walk(directory):
+            dirs.sort()
+            for path in [root] + [os.path.join(root, name) for name in sorted(files)]:
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                digest.update(f'{path} {stat.st_mtime_ns} {stat.st_size}\n'.encode('utf-8'))
+    return digest.hexdigest()
+
+def get_status(compliance_check: bool=True, output: str=None) -> Dict[str, Any]:
     """Returns 'saptune status'.
+    If `output` is given, it is used instead of calling saptune.
     Calls module.fail_json() in case of an error."""
     
-    command = ['saptune', '--format', 'json', 'status']
-    if not compliance_check:
-        command.append('--non-compliance-check')
-    output = execute(command, ignore_error=True)
-    try: 
-        json_output = json.loads(output)
-    except json.decoder.JSONDecodeError:
-        module.fail_json(msg='No or broken JSON output of \'saptune --format json status\'. Is saptune version to old (<3.1) or does not run as root?', **result)
-    if not json_output['result']:
-        module.fail_json(msg='\'saptune --format json status\' returned an empty result!', **result)
-    
-    result['saptune_status'] = json_output['result']    
+    if output is None:
+        output = execute(status_command(compliance_check), ignore_error=True, capture_stdout=False)
+    result['saptune_status'] = parse_status(output)
     return result['saptune_status']
+
+def get_tuning_state(status: Dict[str, Any]) -> str:
+    """Returns the 'tuning state' of the given status.
+    If the status has been retrieved without compliance check,
+    'saptune status' gets called again with the check and the 
+    given status is updated in place.
+    Calls module.fail_json() in case of an error."""
+
+    if status.get('tuning state', 'unknown').startswith('unknown'):
+        status.update(get_status(compliance_check=True))
+    return status['tuning state']
  
 def set_staging(is_value: bool, should_value: bool) -> List[List[str]]:
     """Returns the commands to set the staging to the desired state."""
@@ -309,154 +642,251 @@ def set_service(service: str, current_state: str, target_state: str) -> List[Lis
     
     return commands
 
+def coalesce_commands(commands: List[List[str]]) -> List[List[str]]:
+    """Takes the planned commands and merges each sequence of
+    `systemctl` commands into as few invocations as possible.
+    
+    All other commands are left untouched and act as barrier,
+    so ordering constraints with them (like stopping saptune.service
+    before any tuning if `keep_applied_if_stopped` is set) remain.
+    Inside a sequence, failed states are reset first, then units
+    get stopped and disabled and finally enabled and started, so
+    conflicting services are out of the way before saptune.service
+    is started."""
+
+    coalesced = []
+    sequence = []
+    for command in commands + [None]:
+        if command and command[0] == 'systemctl':
+            sequence.append(command)
+            continue
+        if sequence:
+            coalesced.extend(merge_systemctl_commands(sequence))
+            sequence = []
+        if command:
+            coalesced.append(command)
+    return coalesced
+
+def merge_systemctl_commands(commands: List[List[str]]) -> List[List[str]]:
+    """Merges the given `systemctl VERB UNIT` commands. Disabling 
+    and stopping of the same unit becomes `disable --now`, enabling
+    and starting `enable --now`."""
+
+    units = {verb: [] for verb in ('reset-failed', 'disable', 'stop', 'enable', 'start')}
+    for _, verb, unit in commands:
+        if unit not in units[verb]:
+            units[verb].append(unit)
+
+    merged = []
+    for verb, now_verb in ('reset-failed', None), ('disable', 'stop'), ('enable', 'start'):
+        if now_verb:
+            now_units = [unit for unit in units[verb] if unit in units[now_verb]]
+            if now_units:
+                merged.append(['systemctl', verb, '--now'] + now_units)
+            for each in verb, now_verb:
+                remaining = [unit for unit in units[each] if unit not in now_units]
+                if remaining:
+                    merged.append(['systemctl', each] + remaining)
+        elif units[verb]:
+            merged.append(['systemctl', verb] + units[verb])
+    return merged
+
 def set_apply(existing_notes: List[str],
               existing_solutions: List[str],
               solution_map: Dict[str, List[str]],
               apply_list: List[str],
               current_applied_notes: List[str],
               current_applied_solution: str,
-              current_compliance_status: bool,
+              current_enabled_notes: List[str],
+              current_enabled_solution: str,
+              start_sufficient: bool,
+              get_compliance: Callable[[], bool],
+              get_non_compliant_notes: Callable[[List[str]], List[str]],
               ignore_non_compliant: bool,
-              force_reapply: bool) -> Tuple[List[str], str, List[List[str]]]:
-    """Takes the apply list and calculates the effective Notes
-    (how "applied Notes" should look like) and the effective
-    Solution (what "applied Solution" should list) as well as
-    the commands to achieve it. All three are returned.
+              force_reapply: bool,
+              incremental: bool,
+              reapply: List[str]) -> Tuple[List[str], str, List[List[str]]]:
+    """Takes the apply list and returns the effective Notes
+    (how "applied Notes" should look like), the effective
+    Solution (what "applied Solution" should list) and the 
+    commands to achieve it. The planning is done by plan_apply()
+    and plan_tuning() (see there).
     
-    If the calculated Notes and Solution does not differ
-    from the current ones and the system is compliant and we shall
-    check for it, an empty command list is returned.
-    
-    If there is a difference, a non-comliance we should consider
-    or `force_reapply` is set, the calculated commands are returned,
-    starting with a `saptune revert all`.
+    If Notes get repaired, they are stored in result['repaired_notes'].
 
-    In case of an error module.fail_json() gets called.
-    
-    Important:
-    No optimizations are done to remove unnecessary applies or reverts.
-    Some users may create "interesting" apply lists, but adding complex
-    code to mimic saptune behavior for such rare events is too risky. 
-    It can introduce bugs and requires adaptation if saptune changes 
-    its behavior. In the worst case a version switch might become necessary.
-       
-    Nevertheless we track Note apply and removal to calculate the 
-    effective Note list as well we check if all Notes of a Solution
-    have been removed to reset the effective Solution. Saptune will
-    do the same."""
-    
-    effective_notes = OrderedSet()
-    effective_solution = None
-    commands = [['saptune', 'revert', 'all']]
-    effective_solution_notes = None
- 
-    # Walk through the apply list.
-    solution = None
-    for entry in apply_list:
+    In case of an error module.fail_json() gets called."""
 
-        # A Solution may not have a minus operator.
-        if entry[0:2] == '-@':
-            module.fail_json(msg=f'Solutions cannot have a minus operator: \'{entry}\'', **result)
-        
-        # Set operator and remove it from entry.
-        if entry[0] == '-':
-            operator = '-'
-            entry = entry[1:]
-        else:
-            operator = '+'
-
-        # Process the entry.
-        if entry[0] == '@':    # Solution
-            entry = entry[1:]
-            if entry not in existing_solutions:
-                module.fail_json(msg=f'Solution \'{entry}\' is unknown!', **result)
-            if effective_solution:
-                module.fail_json(msg=f'Only one Solution is allowed!', **result)
-            effective_solution = entry
-            effective_solution_notes = OrderedSet(solution_map[entry]) 
-            effective_notes.update(effective_solution_notes)
-            commands.append(['saptune', 'solution', 'apply', entry])
-        else:   # Note
-            if entry not in existing_notes:
-                module.fail_json(msg=f'Note \'{entry}\' is unknown!', **result)
-            if operator == '+':
-                if entry not in effective_notes: 
-                    effective_notes.add(entry)
-                    commands.append(['saptune', 'note', 'apply', entry])
-            else:
-                if entry in effective_notes:
-                    effective_notes.discard(entry)
-                    commands.append(['saptune', 'note', 'revert', entry])
-               
-        # If the Notes of a Solution all have been removed, the Solution is removed.
-        if effective_solution:  
-            if not effective_notes.intersection(effective_solution_notes):
-                effective_solution = None
-                effective_solution_notes = None
-                
-            else:
-                result['c'] = f'Notes of {effective_solution} not fully reverted'
-    
-    # If our calculated configuration is already applied, then no
-    # commands need to be executed except force_reapply is set.
-    if not force_reapply:
-        if effective_solution == current_applied_solution and current_applied_notes == list(effective_notes):
-            
-            # If we have no tuning (no Notes have been selected), 
-            # we return with an empty command list.
-            if not current_applied_notes:
-                return list(effective_notes), effective_solution, []
-            
-            # If the tuned system is compliant and we shall not ignore that,
-            # we return with an empty command list.
-            if not ignore_non_compliant and current_compliance_status:
-                return list(effective_notes), effective_solution, []  
-
-    return list(effective_notes), effective_solution, commands
+    from ansible.module_utils.saptune_plan import plan_apply, plan_tuning
 
-def run_module():
-    
-    # We need those objects in all functions.
-    global module
-    global result
-    
-    # Define module arguments/parameters.
-    module_args = dict(
-        apply=dict(type='list', elements='str', required=False, default=[' __keep_current_tuning__ ']),
-        force_reapply=dict(type='bool', required=False, default=False),
-        no_tuned=dict(type='bool', required=False, default=True),
-        no_sapconf=dict(type='bool', required=False, default=True),
-        enabled=dict(type='bool', required=False, default=True),
-        started=dict(type='bool', required=False, default=True),
-        keep_applied_if_stopped=dict(type='bool', required=False, default=False),
-        ignore_non_compliant=dict(type='bool', required=False, default=False),
-        ignore_degraded=dict(type='bool', required=False, default=True),
-        staging_enabled=dict(type='bool', required=False, default=False)   
-    )
+    plan = plan_apply(apply_list, existing_notes, existing_solutions, solution_map)
+    if plan.errors:
+        module.fail_json(msg=plan.errors[0]['msg'], apply_errors=plan.errors, **result)
 
-    # Start to build up the result object.
-    result = dict(
-        changed = False,
-        commands = [],
-        saptune_status = {}
-    )
-    message = None  # cannot set result['msg'] directly or we get errors.
+    commands, repaired_notes = plan_tuning(plan,
+                                           solution_map,
+                                           current_applied_notes,
+                                           current_applied_solution,
+                                           current_enabled_notes,
+                                           current_enabled_solution,
+                                           start_sufficient,
+                                           get_compliance,
+                                           get_non_compliant_notes,
+                                           ignore_non_compliant,
+                                           force_reapply,
+                                           incremental,
+                                           reapply)
+    if repaired_notes is not None:
+        result['repaired_notes'] = repaired_notes
+    return plan.notes, plan.solution, commands
 
-    # Instantiate the Ansible module.
-    module = AnsibleModule(
-        argument_spec=module_args,
-        supports_check_mode=True
-    )
+def get_staged_items(status: Dict[str, Any], apply_list: List[str]) -> List[str]:
+    """Returns the staged Notes and Solutions the apply list refers to."""
 
-    # The command list to get saptune to the desired state.
-    command_list = []
+    referenced = {entry.lstrip('-').lstrip('@') for entry in apply_list}
+    staged = status['staging'].get('Notes staged', []) + status['staging'].get('Solutions staged', [])
+    return [item for item in staged if item in referenced]
+
+def add_staged_items(catalog: Tuple[List[str], List[str], Dict[str, List[str]]], status: Dict[str, Any]) -> Tuple[List[str], List[str], Dict[str, List[str]]]:
+    """Returns the catalog extended by the staged Notes and Solutions,
+    so an apply list referring to them can be validated before they
+    are released. The Notes of a staged Solution are unknown then,
+    so an existing Solution keeps its Notes and a new one has none."""
+
+    existing_notes, existing_solutions, solution_map = catalog
+    staged_notes = [note for note in status['staging'].get('Notes staged', []) if note not in existing_notes]
+    staged_solutions = [solution for solution in status['staging'].get('Solutions staged', []) if solution not in existing_solutions]
+    return (existing_notes + staged_notes, 
+            existing_solutions + staged_solutions, 
+            dict(solution_map, **{solution: [] for solution in staged_solutions}))
+
+def prepare_rollout(status: Dict[str, Any], catalog: Tuple[List[str], List[str], Dict[str, List[str]]]) -> None:
+    """Prepares the rollout of the apply list: validates it against
+    the available and staged Notes and Solutions, enables staging and
+    plans the release run. The staged Notes and Solutions the apply 
+    list refers to are written to `rollout.json` in `cache_dir`, 
+    together with what the release run needs to skip discovery and 
+    planning (see get_prepared_release()): the state token, the status,
+    the catalog extended by the staged items and the planned commands.
+    A staged Solution, which is not known yet, has no known Notes, so
+    nothing gets planned if the apply list refers to one.
+    The tuning is not touched.
+    Calls module.exit_json() or, in case of an error, module.fail_json()."""
+
+    from ansible.module_utils.saptune_plan import plan_apply
+
+    commands = set_staging(status['staging']['staging enabled'], module.params['staging_enabled'])
+    staged_catalog = add_staged_items(catalog, status)
+    plan = plan_apply(module.params['apply'], *staged_catalog)
+    if plan.errors:
+        module.fail_json(msg=plan.errors[0]['msg'], apply_errors=plan.errors, **result)
+
+    result['release'] = get_staged_items(status, module.params['apply'])
+    result['commands'] = [' '.join(command) for command in commands]
+    if module.check_mode:
+        result['msg'] = 'Do nothing because check_mode is set.'
+        result['rc'] = 0
+        module.exit_json(**result)
+
+    for command in commands:
+        execute(command)
+    result['changed'] = bool(commands)
+    record_phase('execution')
+
+    # Plan the release run the way it will find the host: staging 
+    # enabled and the staged items released.
+    prepared = None
+    if not any(solution in result['release'] for solution in staged_catalog[1] if solution not in catalog[1]):
+        status['staging']['staging enabled'] = module.params['staging_enabled']
+        blocks = plan_changes(status, staged_catalog)
+        prepared = {'state token': state_fingerprint(),
+                    'params': {key: module.params[key] for key in JOURNAL_PARAMS},
+                    'status': status,
+                    'catalog': list(staged_catalog),
+                    'blocks': list(blocks[:3]),
+                    'notes': blocks[3],
+                    'solution': blocks[4],
+                    'repaired_notes': result.pop('repaired_notes', None)}
+        record_phase('planning')
+    write_cache('rollout.json', {'apply': module.params['apply'], 
+                                 'release': result['release'],
+                                 'package version': status['package version'],
+                                 'prepared': prepared})
+    result['rc'] = 0
+    result['msg'] = 'Rollout has been prepared.'
+    module.exit_json(**result)
+
+def read_rollout() -> Dict[str, Any]:
+    """Returns the record of the rollout prepared for the apply list.
+    Calls module.fail_json() if there is none."""
+
+    rollout = read_cache('rollout.json')
+    if not rollout or rollout.get('apply') != module.params['apply']:
+        module.fail_json(msg='No rollout has been prepared for this apply list. Run with rollout=prepare first!', **result)
+    return rollout
+
+def get_prepared_release(rollout: Dict[str, Any]) -> Dict[str, Any]:
+    """Returns what the prepare run has planned for the release run
+    (see prepare_rollout()), if the state token of the host and the
+    parameters are still the same, otherwise None.
+    The compliance might have changed nevertheless, so the 'tuning 
+    state' of the prepared status is set to unknown. The plan is 
+    based on the compliance at prepare time, a later deviation is 
+    detected by the final check."""
+
+    prepared = rollout.get('prepared')
+    try:
+        if prepared and prepared['state token'] == state_fingerprint() and \
+           prepared['params'] == {key: module.params[key] for key in JOURNAL_PARAMS}:
+            prepared['status']['tuning state'] = 'unknown (prepared)'
+            return prepared
+    except (KeyError, TypeError):
+        pass
+    return None
+
+def release_rollout(status: Dict[str, Any], rollout: Dict[str, Any]) -> List[List[str]]:
+    """Releases the staged Notes and Solutions recorded for the apply
+    list by a previous run with `rollout=prepare` in a single 
+    `saptune staging release` and returns the executed command (if any).
+    Items no longer staged are skipped.
+    Calls module.fail_json() in case of an error."""
+
+    staged = status['staging'].get('Notes staged', []) + status['staging'].get('Solutions staged', [])
+    release = [item for item in rollout['release'] if item in staged]
+    result['release'] = release
+    if not release:
+        return []
+    command = ['saptune', 'staging', 'release', '--force'] + release
+    if not module.check_mode:
+        execute(command)
+        result['changed'] = True
+    return [command]
+
+def plan_changes(status: Dict[str, Any], 
+                 catalog: Tuple[List[str], List[str], Dict[str, List[str]]], 
+                 resumed_tuning: List[List[str]]=None) -> Tuple[List[List[str]], List[List[str]], List[List[str]], List[str], str]:
+    """Returns the commands to get from the given status to the
+    desired state and the effective Notes and Solution (None, if 
+    the tuning shall be left alone).
+    
+    The commands are split into three blocks: the commands which 
+    have to run before the tuning changes, the tuning changes 
+    themselves (while they run the system is not tuned as desired)
+    and the commands which can run afterwards.
 
-    # Call status to collect the current settings.
-    status = get_status(compliance_check=True)
+    If the remaining tuning commands of an interrupted run are given
+    (see resume_journal()), they are taken as they are instead of 
+    planning the tuning, the effective Notes and Solution are None
+    then. The other blocks are planned from the given status anyway.
+    Calls module.fail_json() in case of an error."""
+
+    command_list = []
+    tuning_commands = list(resumed_tuning) if resumed_tuning is not None else []
+    post_commands = []
+    plan_tuning = resumed_tuning is None
 
     # Set staging.
-    command_list.extend(set_staging(module.params['staging_enabled'], 
-                                    status['staging']['staging enabled']))
+    command_list.extend(set_staging(status['staging']['staging enabled'],
+                                    module.params['staging_enabled']))
 
     # Take care of tuneD. 
     if module.params['no_tuned']:
@@ -473,55 +903,515 @@ def run_module():
                 command_list.extend(set_service('sapconf.service', is_value, should_value))
         
     # Take care of saptune.service (in regards to enable/disable only).
+    # This only affects the next boot, so it is done after the tuning.
     should_value = 'enabled' if  module.params['enabled'] else 'disabled'   
-    command_list.extend(set_service('saptune.service', 
+    post_commands.extend(set_service('saptune.service', 
                                     status['services']['saptune'][0], 
                                     should_value))
        
     # If keep_applied_if_stopped is set to true, we need to
-    # stop saptune.service now if this is the desired state,
-    # otherwise stopping it later would remove the tuning.
+    # stop saptune.service as first tuning command if this is the
+    # desired state, otherwise stopping it later would remove the 
+    # tuning. Resetting a failed state can be done upfront.
     saptune_stop_handled = False
-    if module.params['keep_applied_if_stopped']:
+    if module.params['keep_applied_if_stopped'] and plan_tuning:
         if not module.params['started']:
-            command_list.extend(set_service('saptune.service', 
-                                           status['services']['saptune'][1], 
-                                           'inactive'))
+            for command in set_service('saptune.service', status['services']['saptune'][1], 'inactive'):
+                if command[1] == 'reset-failed':
+                    command_list.append(command)
+                else:
+                    tuning_commands.append(command)
             saptune_stop_handled = True
         
     # Generate the commands depending on the apply list.
-    if module.params['apply'] == None:  # we need `apply` always to be a list
-        module.params['apply'] = []
-
     # module.params['apply'] can be
     #   - [] -> `apply` is empty, so no tuning shall be applied
     #   - [...] -> `apply` is given and describes the expected tuning
     #   - [' __keep_current_tuning__ '] -> `apply` is missing, so tuning shall be left alone
-    if ' __keep_current_tuning__ ' not in module.params['apply']:
-        existing_notes, existing_solutions, solution_map = get_notes_and_solutions()
+    if ' __keep_current_tuning__ ' not in module.params['apply'] and plan_tuning:
+        existing_notes, existing_solutions, solution_map = catalog
+        applied_notes = status['Notes applied']
         applied_solution = status['Solution applied'][0]['Solution ID'] if status['Solution applied'] else None
+        enabled_solution = status['Solution enabled'][0] if status['Solution enabled'] else None
+        # Stopping saptune.service first reverts the applied tuning.
+        if ['systemctl', 'stop', 'saptune.service'] in tuning_commands:
+            applied_notes, applied_solution = [], None
+        start_sufficient = status['services']['saptune'][1] != 'active' and \
+                           (module.params['started'] or not module.params['keep_applied_if_stopped'])
+        # Applied Notes and Solutions released from staging have a new
+        # definition, so they have to be applied again.
         effective_notes, effective_solution, commands = set_apply(existing_notes,
                                                                   existing_solutions,
                                                                   solution_map,
                                                                   module.params['apply'],
-                                                                  status['Notes applied'],
+                                                                  applied_notes,
                                                                   applied_solution,
-                                                                  status['tuning state'] if 'tuning state' in status else False,
+                                                                  status['Notes enabled'],
+                                                                  enabled_solution,
+                                                                  start_sufficient,
+                                                                  lambda: get_tuning_state(status) == 'compliant',
+                                                                  get_non_compliant_notes if module.params['repair_non_compliant'] else None,
                                                                   module.params['ignore_non_compliant'],
-                                                                  module.params['force_reapply'])
-        command_list.extend(commands)
+                                                                  module.params['force_reapply'],
+                                                                  module.params['incremental'],
+                                                                  result.get('release', []))
+        tuning_commands.extend(commands)
     else:
         effective_notes, effective_solution = None, None
     
-    # Handle saptune.service start/stop if not done earlier.
+    # Handle saptune.service start/stop if not done earlier. Starting
+    # or stopping it changes the tuning, resetting a failed state
+    # can be done upfront.
     if not saptune_stop_handled:
         should_value = 'active' if  module.params['started'] else 'inactive'   
-        command_list.extend(set_service('saptune.service', 
-                                        status['services']['saptune'][1], 
-                                        should_value))
+        for command in set_service('saptune.service', status['services']['saptune'][1], should_value):
+            if command[1] == 'reset-failed':
+                command_list.append(command)
+            elif plan_tuning:
+                tuning_commands.append(command)
         
-    # All actions have been planned.
-    result['commands'] = [' '.join(command) for command in command_list]        
+    # Enabling (disabling) saptune.service has to wait for the tuning,
+    # but if it gets started (stopped) as the last tuning command, both
+    # can be done at once. Resumed tuning commands are merged already.
+    for verb, now_verb in ('enable', 'start'), ('disable', 'stop'):
+        command = ['systemctl', verb, 'saptune.service']
+        if command in post_commands:
+            if ['systemctl', verb, '--now', 'saptune.service'] in tuning_commands:
+                post_commands.remove(command)
+            elif plan_tuning and tuning_commands[-1:] == [['systemctl', now_verb, 'saptune.service']]:
+                post_commands.remove(command)
+                tuning_commands.append(command)
+
+    # All actions have been planned. Merge the systemctl calls
+    # within each block.
+    command_list, post_commands = coalesce_commands(command_list), coalesce_commands(post_commands)
+    if plan_tuning:
+        tuning_commands = coalesce_commands(tuning_commands)
+    return command_list, tuning_commands, post_commands, effective_notes, effective_solution
+
+def get_journal_plan(status: Dict[str, Any], 
+                     catalog: Tuple[List[str], List[str], Dict[str, List[str]]], 
+                     blocks: List[List[List[str]]],
+                     effective_notes: List[str],
+                     effective_solution: str,
+                     snapshot: Dict[str, Any]=None) -> Dict[str, Any]:
+    """Returns the plan for the journal: the parameters the planning
+    depends on, the blocks of commands, the applied Notes and Solution
+    expected before the first and after each command, the effective
+    Notes and Solution, the repaired Notes and the snapshot of the 
+    state before the changes (see get_snapshot()). A resumed run
+    passes the snapshot of the interrupted one."""
+
+    from ansible.module_utils.saptune_plan import plan_expected_tunings
+
+    current = get_snapshot(status)
+    expected = plan_expected_tunings([command for block in blocks for command in block],
+                                     catalog[2] if catalog else {},
+                                     current['notes_applied'],
+                                     current['solution_applied'],
+                                     current['notes_enabled'],
+                                     current['solution_enabled'])
+    return {'params': {key: module.params[key] for key in JOURNAL_PARAMS},
+            'blocks': blocks,
+            'expected': [[current['notes_applied'], current['solution_applied']]] + [list(tuning) for tuning in expected],
+            'notes': effective_notes,
+            'solution': effective_solution,
+            'repaired_notes': result.get('repaired_notes'),
+            'snapshot': snapshot or current}
+
+def resume_journal(status: Dict[str, Any]) -> Tuple[Dict[str, Any], int]:
+    """Returns the plan of the journal of an interrupted run (with 
+    the remaining commands of the tuning block added as `remaining`)
+    and the step to resume at, if the run had the same parameters and
+    the applied Notes and Solution match the ones expected before
+    the first unfinished step (or the step after it, if the command
+    had finished but not been recorded). Otherwise the journal gets
+    removed (not in check mode) and (None, 0) is returned."""
+
+    from ansible.module_utils.saptune_journal import read_journal, remove_journal
+
+    journal, done = read_journal()
+    if journal is None:
+        return None, 0
+    try:
+        if journal['params'] == {key: module.params[key] for key in JOURNAL_PARAMS}:
+            applied_solution = status['Solution applied'][0]['Solution ID'] if status['Solution applied'] else None
+            current = [status['Notes applied'], applied_solution]
+            for step in done, done + 1:
+                if step < len(journal['expected']) and journal['expected'][step] == current:
+                    offset = step - len(journal['blocks'][0])
+                    journal['remaining'] = journal['blocks'][1][max(offset, 0):]
+                    return journal, step
+    except (KeyError, TypeError, IndexError):
+        pass
+    module.warn('Discarding the journal of an interrupted run, which does not match the current parameters or state.')
+    if not module.check_mode:
+        remove_journal()
+    return None, 0
+
+def execute_changes(command_list: List[List[str]], 
+                    tuning_commands: List[List[str]], 
+                    post_commands: List[List[str]], 
+                    journal: Dict[str, Any]=None) -> None:
+    """Executes the blocks of commands (see plan_changes()). If the
+    plan for the journal is given, the journal gets written first,
+    each finished step recorded and the journal is removed once all
+    commands have been executed.
+    Calls module.fail_json() in case of an error."""
+
+    if journal:
+        from ansible.module_utils.saptune_journal import start_journal, record_step, remove_journal
+        start_journal(journal)
+        steps = iter(range(1, 1 + len(command_list) + len(tuning_commands) + len(post_commands)))
+        finished = lambda: record_step(next(steps))
+    else:
+        finished = None
+
+    for command in command_list:
+        execute(command)
+        if finished:
+            finished()
+    execute_window(tuning_commands, finished)
+    for command in post_commands:
+        execute(command)
+        if finished:
+            finished()
+    if journal:
+        remove_journal()
+
+def get_snapshot(status: Dict[str, Any]) -> Dict[str, Any]:
+    """Returns the parts of the given status a rollback restores:
+    the applied and enabled Solution and Notes (in order), staging 
+    and the state of the services."""
+
+    return {'solution_applied': status['Solution applied'][0]['Solution ID'] if status['Solution applied'] else None,
+            'notes_applied': list(status['Notes applied']),
+            'solution_enabled': status['Solution enabled'][0] if status['Solution enabled'] else None,
+            'notes_enabled': list(status['Notes enabled']),
+            'staging_enabled': status['staging']['staging enabled'],
+            'services': {service: list(states) for service, states in status['services'].items()}}
+
+def get_snapshot_differences(snapshot: Dict[str, Any], current: Dict[str, Any]) -> List[str]:
+    """Returns the parts of the snapshot the current one (both from
+    get_snapshot()) differs in. The applied tuning always counts,
+    the enabled one only if saptune.service is not active (as in 
+    the final check of the module)."""
+
+    differences = [key for key in ('staging_enabled', 'services') if snapshot[key] != current[key]]
+    kinds = ['applied'] if snapshot['services']['saptune'][1] == 'active' else ['applied', 'enabled']
+    differences.extend(f'{name}_{kind}' for kind in kinds for name in ('solution', 'notes') 
+                       if snapshot[f'{name}_{kind}'] != current[f'{name}_{kind}'])
+    return differences
+
+def plan_restore_commands(notes: List[str], 
+                          solution: str, 
+                          current_notes: List[str], 
+                          current_solution: str, 
+                          solution_map: Dict[str, List[str]]) -> List[List[str]]:
+    """Returns the commands to get from the current tuning back to 
+    the given Notes and Solution. They are planned by plan_incremental()
+    from the current Notes and Solution, if they are given, otherwise 
+    or if this does not save anything, starting with `saptune revert all`
+    (see plan_restore())."""
+
+    from ansible.module_utils.saptune_plan import plan_restore, plan_incremental
+
+    plan = plan_restore(notes, solution, solution_map)
+    if current_notes is not None:
+        commands = plan_incremental(plan.commands[1:], solution_map, current_notes, current_solution)
+        if commands is not None:
+            return commands
+    return plan.commands
+
+def plan_rollback(snapshot: Dict[str, Any], current: Dict[str, Any], solution_map: Dict[str, List[str]]) -> List[List[str]]:
+    """Returns the commands to get from the current state back to the
+    snapshot (both from get_snapshot()).
+
+    The tuning can only be restored by applying it. The applies 
+    start from the current tuning, if the applied and enabled one 
+    are the same (see plan_restore_commands()).
+    If saptune.service was active, the applied tuning is restored 
+    before it gets started (so starting it does not apply anything
+    else). Otherwise the enabled tuning is restored: if the snapshot
+    has it applied as well (`keep_applied_if_stopped`) after stopping 
+    saptune.service, if not while saptune.service runs, which gets
+    stopped afterwards, so the tuning gets reverted, but stays 
+    enabled.
+    tuned.service and sapconf.service come last, they have been 
+    running next to the tuning before."""
+
+    saptune_states = snapshot['services']['saptune']
+    current_state = current['services']['saptune'][1]
+    differences = get_snapshot_differences(snapshot, current)
+    consistent = current['notes_applied'] == current['notes_enabled'] and \
+                 current['solution_applied'] == current['solution_enabled']
+    commands = set_staging(current['staging_enabled'], snapshot['staging_enabled'])
+    stop_commands = []
+    if saptune_states[1] == 'active':
+        if any(key.endswith('_applied') for key in differences):
+            start_sufficient = current_state != 'active' and \
+                               current['solution_enabled'] == snapshot['solution_applied'] and \
+                               current['notes_enabled'] == snapshot['notes_applied']
+            if not start_sufficient:
+                commands.extend(plan_restore_commands(snapshot['notes_applied'], 
+                                                      snapshot['solution_applied'],
+                                                      current['notes_applied'] if consistent else None, 
+                                                      current['solution_applied'], 
+                                                      solution_map))
+        commands.extend(set_service('saptune.service', current_state, saptune_states[1]))
+    elif snapshot['notes_applied'] or snapshot['solution_applied']:
+        commands.extend(set_service('saptune.service', current_state, saptune_states[1]))
+        if current_state == 'active' or any(key.startswith(('solution_', 'notes_')) for key in differences):
+            running = current_state == 'active'
+            commands.extend(plan_restore_commands(snapshot['notes_enabled'], 
+                                                  snapshot['solution_enabled'],
+                                                  current['notes_applied'] if consistent and not running else None,
+                                                  current['solution_applied'], 
+                                                  solution_map))
+    else:
+        enabled_differs = any(key.endswith('_enabled') for key in differences)
+        if enabled_differs or current['notes_applied'] or current['solution_applied']:
+            commands.extend(set_service('saptune.service', current_state, 'active'))
+            if enabled_differs:
+                commands.extend(plan_restore_commands(snapshot['notes_enabled'], 
+                                                      snapshot['solution_enabled'],
+                                                      current['notes_enabled'] if consistent or not current['notes_applied'] else None, 
+                                                      current['solution_enabled'], 
+                                                      solution_map))
+            stop_commands = [['systemctl', 'stop', 'saptune.service']]
+        else:
+            commands.extend(set_service('saptune.service', current_state, saptune_states[1]))
+
+    # The stop must not be merged with a start before it.
+    commands = coalesce_commands(commands)
+    commands.extend(stop_commands)
+    final_commands = set_service('saptune.service', current['services']['saptune'][0], saptune_states[0])
+    for service in ('tuned', 'sapconf'):
+        if snapshot['services'].get(service) and current['services'].get(service):
+            for index in (0, 1):
+                final_commands.extend(set_service(f'{service}.service', current['services'][service][index], snapshot['services'][service][index]))
+    return commands + coalesce_commands(final_commands)
+
+def rollback(snapshot: Dict[str, Any], catalog: Tuple[List[str], List[str], Dict[str, List[str]]], reason: str) -> None:
+    """Restores the snapshot taken before the changes (see 
+    get_snapshot()) after a failure and reports the commands,
+    the outcome and the duration in result['rollback'].
+    Used as failure handler, so module.fail_json() raises 
+    HandlerFailure, which ends the rollback."""
+
+    start = time.monotonic()
+    rollback_result = result['rollback'] = {'reason': reason, 'snapshot': snapshot, 'commands': []}
+    try:
+        current = get_snapshot(get_status(compliance_check=False))
+        if catalog is None and get_snapshot_differences(snapshot, current):
+            _, catalog = get_status_and_catalog(with_catalog=True, status=result['saptune_status'])
+        commands = plan_rollback(snapshot, current, catalog[2] if catalog else {})
+        rollback_result['commands'] = [' '.join(command) for command in commands]
+        for command in commands:
+            execute(command)
+        if commands:
+            current = get_snapshot(get_status(compliance_check=False))
+        rollback_result['differences'] = get_snapshot_differences(snapshot, current)
+        rollback_result['outcome'] = 'incomplete' if rollback_result['differences'] else 'restored'
+        if rollback_result['outcome'] == 'restored' and module.params['journal']:
+            from ansible.module_utils.saptune_journal import remove_journal
+            remove_journal()
+    except HandlerFailure as err:
+        rollback_result['outcome'] = 'failed'
+        rollback_result['error'] = str(err)
+    rollback_result['duration'] = round(time.monotonic() - start, 3)
+
+def get_non_compliant_notes(notes: List[str]) -> List[str]:
+    """Returns the given (applied) Notes which are not compliant.
+    Calls module.fail_json() in case of an error."""
+
+    compliance = get_note_compliance(notes)
+    return [note for note, state in compliance.items() if not state['compliant']]
+
+def verify_changes(previous_status: Dict[str, Any], 
+                   catalog: Tuple[List[str], List[str], Dict[str, List[str]]], 
+                   commands: List[List[str]],
+                   repair_verified: bool=False) -> Tuple[Dict[str, Any], Dict[str, Dict[str, Any]]]:
+    """Returns the status after the given commands have been executed
+    on the given previous status and the compliance of the verified
+    Notes (None, if no Note has been verified).
+
+    The status is retrieved without compliance check and only the
+    applied Notes, whose compliance is not known, get verified: the
+    ones the commands may have changed (see plan_changed_notes()), 
+    released ones and all of them, if the previous status has not 
+    been compliant (unless `repair_verified` tells that a repair in
+    this run has verified the others). The 
+    'tuning state' of the status is set from the result. If all
+    Notes expected to be applied (or none) would have to be verified,
+    a single 'saptune status' with compliance check is used instead.
+    Calls module.fail_json() in case of an error."""
+
+    from ansible.module_utils.saptune_plan import plan_expected_tunings, plan_changed_notes
+
+    if module.params['ignore_non_compliant']:
+        return get_status(compliance_check=False), None
+
+    snapshot = get_snapshot(previous_status)
+    tunings = [(snapshot['notes_applied'], snapshot['solution_applied'])]
+    tunings.extend(plan_expected_tunings(commands,
+                                         catalog[2] if catalog else {},
+                                         snapshot['notes_applied'],
+                                         snapshot['solution_applied'],
+                                         snapshot['notes_enabled'],
+                                         snapshot['solution_enabled']))
+    unchanged = set()
+    if previous_status.get('tuning state') == 'compliant' or repair_verified:
+        unchanged = set(snapshot['notes_applied']) - set(plan_changed_notes(tunings)) - set(result.get('release', []))
+    if all(note not in unchanged for note in tunings[-1][0]):
+        return get_status(compliance_check=True), None
+    status = get_status(compliance_check=False)
+    compliance = get_note_compliance([note for note in status['Notes applied'] if note not in unchanged])
+    compliant = all(state['compliant'] for state in compliance.values())
+    status['tuning state'] = 'compliant' if compliant else 'not compliant'
+    return status, compliance
+
+def run_module():
+    
+    # We need those objects in all functions.
+    global module
+    global result
+    
+    # Define module arguments/parameters.
+    module_args = dict(
+        apply=dict(type='list', elements='str', required=False, default=[' __keep_current_tuning__ ']),
+        force_reapply=dict(type='bool', required=False, default=False),
+        incremental=dict(type='bool', required=False, default=False),
+        rollout=dict(type='str', required=False, default='none', choices=['none', 'prepare', 'release']),
+        repair_non_compliant=dict(type='bool', required=False, default=False),
+        rollback_on_failure=dict(type='bool', required=False, default=False),
+        journal=dict(type='bool', required=False, default=True),
+        verify_workers=dict(type='int', required=False, default=4),
+        no_tuned=dict(type='bool', required=False, default=True),
+        no_sapconf=dict(type='bool', required=False, default=True),
+        enabled=dict(type='bool', required=False, default=True),
+        started=dict(type='bool', required=False, default=True),
+        keep_applied_if_stopped=dict(type='bool', required=False, default=False),
+        ignore_non_compliant=dict(type='bool', required=False, default=False),
+        ignore_degraded=dict(type='bool', required=False, default=True),
+        staging_enabled=dict(type='bool', required=False, default=False),
+        catalog_cache=dict(type='bool', required=False, default=True),
+        catalogs=dict(type='list', elements='dict', required=False, default=None),
+        cache_dir=dict(type='path', required=False, default='/var/cache/ansible_saptune'),
+        command_timeout=dict(type='int', required=False, default=600),
+        module_timeout=dict(type='int', required=False, default=0),
+        output_capture=dict(type='str', required=False, default='truncated', choices=['full', 'truncated', 'summary']),
+        output_lines=dict(type='int', required=False, default=10),
+        metrics_file=dict(type='path', required=False),
+        status=dict(type='dict', required=False, default=None),
+        status_token=dict(type='str', required=False, default=None, no_log=False)
+    )
+
+    # Start to build up the result object.
+    result = dict(
+        changed = False,
+        commands = [],
+        saptune_status = {},
+        timings = dict(phases = {}, commands = {}, spawns = 0, total = 0)
+    )
+    message = None  # cannot set result['msg'] directly or we get errors.
+
+    # Instantiate the Ansible module.
+    module = AnsibleModule(
+        argument_spec=module_args,
+        supports_check_mode=True
+    )
+
+    # Phases and commands are timed from here and no command 
+    # shall run beyond the module deadline.
+    setup(module, result)
+
+    for name in ('output_lines', 'command_timeout', 'module_timeout'):
+        if module.params[name] < 0:
+            module.fail_json(msg=f'{name} must not be negative!', **result)
+
+    if module.params['verify_workers'] < 1:
+        module.fail_json(msg='verify_workers must be at least 1!', **result)
+
+    if module.params['apply'] == None:  # we need `apply` always to be a list
+        module.params['apply'] = []
+
+    # Call status to collect the current settings. If the apply
+    # list is given, we need the known Notes and Solutions as well.
+    # The saptune calls for both are done in parallel.
+    # The expensive compliance check is only done if the compliance
+    # might matter. If the tuning gets re-applied anyway, only the 
+    # compliance after the changes counts. Should the compliance be
+    # needed nevertheless, get_tuning_state() will retrieve it.
+    # A status handed over by saptune_facts is used, if the host
+    # still is in the same state.
+    with_catalog = ' __keep_current_tuning__ ' not in module.params['apply']
+    compliance_check = not module.params['ignore_non_compliant'] and \
+                       not (module.params['force_reapply'] and with_catalog)
+    status = None
+    if module.params['status'] and module.params['status_token']:
+        if module.params['status_token'] == state_fingerprint() and \
+           all(key in module.params['status'] for key in STATUS_KEYS):
+            status = module.params['status']
+    rollout = module.params['rollout']
+    if rollout != 'none':
+        if not with_catalog:
+            module.fail_json(msg=f'rollout={rollout} requires an apply list!', **result)
+        if not module.params['staging_enabled']:
+            module.fail_json(msg=f'rollout={rollout} requires staging_enabled!', **result)
+
+    # When releasing, the staged Notes and Solutions get released 
+    # first, so the catalog has to be retrieved afterwards. If the 
+    # host is still in the state the prepare run has left it, its
+    # status, catalog and plan are used instead.
+    release_commands = []
+    prepared = None
+    if rollout == 'release':
+        record = read_rollout()
+        prepared = get_prepared_release(record)
+        if prepared:
+            status = result['saptune_status'] = prepared['status']
+            catalog = tuple(prepared['catalog'])
+            release_commands = release_rollout(status, record)
+        else:
+            status, _ = get_status_and_catalog(compliance_check=compliance_check, with_catalog=False, status=status)
+            release_commands = release_rollout(status, record)
+            status, catalog = get_status_and_catalog(with_catalog=True, status=status, refresh=bool(release_commands))
+            if release_commands and module.check_mode:
+                catalog = add_staged_items(catalog, status)
+    else:
+        status, catalog = get_status_and_catalog(compliance_check=compliance_check, with_catalog=with_catalog, status=status)
+    record_phase('discovery')
+
+    # When preparing a rollout, nothing else is done.
+    if rollout == 'prepare':
+        prepare_rollout(status, catalog)
+
+    # Resume an interrupted run, if its journal still matches the 
+    # state, otherwise plan the changes (unless prepared). Only the 
+    # rest of its tuning is taken from the journal, the other commands
+    # are planned again, since the state might have changed since.
+    # The Notes of a repair have only been verified, if it has been
+    # planned in this run.
+    journal, step = resume_journal(status) if module.params['journal'] and not prepared else (None, 0)
+    repair_verified = False
+    if prepared:
+        command_list, tuning_commands, post_commands = prepared['blocks']
+        effective_notes, effective_solution = prepared['notes'], prepared['solution']
+        if prepared['repaired_notes'] is not None:
+            result['repaired_notes'] = prepared['repaired_notes']
+        result['prepared'] = True
+    elif journal:
+        command_list, tuning_commands, post_commands, _, _ = plan_changes(status, catalog, resumed_tuning=journal['remaining'])
+        effective_notes, effective_solution = journal['notes'], journal['solution']
+        if journal['repaired_notes'] is not None:
+            result['repaired_notes'] = journal['repaired_notes']
+        result['resumed'] = {'step': step, 'steps': sum(len(block) for block in journal['blocks'])}
+    else:
+        command_list, tuning_commands, post_commands, effective_notes, effective_solution = plan_changes(status, catalog)
+        repair_verified = 'repaired_notes' in result
+    result['commands'] = [' '.join(command) for command in release_commands + command_list + tuning_commands + post_commands]        
+    record_phase('planning')
         
     # With check_mode we just return the commands.
     if module.check_mode:
@@ -529,30 +1419,59 @@ def run_module():
         result['rc'] = 0
         module.exit_json(**result)
         
-    # If we have something to execute, we do.
-    if command_list:
-        for command in command_list:
-            execute(command) 
+    # If we have something to execute, we do. Staged Notes and 
+    # Solutions might have been released already.
+    compliance = None
+    if release_commands or journal or command_list or tuning_commands or post_commands:
+
+        # The journal gets written, if requested. A resumed run replaces
+        # the one of the interrupted run, but keeps its snapshot.
+        if module.params['journal'] and (journal or command_list or tuning_commands or post_commands):
+            journal = get_journal_plan(status, catalog, [command_list, tuning_commands, post_commands], 
+                                       effective_notes, effective_solution, 
+                                       journal['snapshot'] if journal else None)
+
+        # From now on a failure restores the state from before, if 
+        # requested.
+        if module.params['rollback_on_failure']:
+            snapshot = journal['snapshot'] if journal else get_snapshot(status)
+            set_failure_handler(lambda msg: rollback(snapshot, catalog, msg))
+
+        execute_changes(command_list, tuning_commands, post_commands, journal)
         result['changed'] = True
+        record_phase('execution')
         
-        # Update the status since we changed something.
-        status = get_status(compliance_check=True)
+        # Update the status since we changed something. Only the
+        # Notes affected by the changes need to be verified again.
+        status, compliance = verify_changes(status, catalog, command_list + tuning_commands + post_commands, repair_verified)
         
         message = 'System has been tuned.'
     else:
         message = 'Nothing to do.'
     
+    # Export the tuning state for monitoring.
+    if module.params['metrics_file']:
+        from ansible.module_utils.saptune_metrics import write_metrics
+        write_metrics(MODULE_NAME, status, compliance, result['changed'])
+
     # Check if applied list matches the config (if we had to tune).
+    # A stopped saptune.service has nothing applied (unless we shall
+    # keep it), so we have to compare with the enabled ones instead.
     if ' __keep_current_tuning__ ' not in module.params['apply']:
-        applied_solution = status['Solution applied'][0]['Solution ID'] if status['Solution applied'] else None
+        if status['services']['saptune'][1] != 'active' and not module.params['keep_applied_if_stopped']:
+            applied_solution = status['Solution enabled'][0] if status['Solution enabled'] else None
+            applied_notes = status['Notes enabled']
+        else:
+            applied_solution = status['Solution applied'][0]['Solution ID'] if status['Solution applied'] else None
+            applied_notes = status['Notes applied']
         if effective_solution != applied_solution:
             module.fail_json(msg=f'Applied Solution ({applied_solution} differs from the expected one ({effective_solution})!', **result)
-        if effective_notes != status['Notes applied']:
-            module.fail_json(msg=f'''Applied Notes ({', '.join(status['Notes applied'])}) differ from the expected ones ({', '.join(effective_notes)})!''', **result)
+        if effective_notes != applied_notes:
+            module.fail_json(msg=f'''Applied Notes ({', '.join(applied_notes)}) differ from the expected ones ({', '.join(effective_notes)})!''', **result)
     
     # Check if we are compliant and shall act on it.
     if not module.params['ignore_non_compliant']:
-        if 'tuning state' in status and status['tuning state'] == 'not compliant':
+        if get_tuning_state(status) == 'not compliant':
             module.fail_json(msg='Tuning is non-compliant!', **result)
     
     # Check if we have a degraded systemd system state and shall act on it.
@@ -561,6 +1480,7 @@ def run_module():
             module.fail_json(msg='Systemd system state is degraded!', **result)
 
     # All went well...
+    record_phase('verification')
     result['rc'] = 0
     result['msg'] = message
     module.exit_json(**result)
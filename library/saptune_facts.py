@@ -18,14 +18,103 @@ version_added: "0.0.1"
 description: 
         The module will make the result of C(saptune --format json status) available 
         as Ansible fact.
+        Additionally a state token is returned, which can be handed over to the
+        C(saptune) module together with the status to avoid another C(saptune status).
 
 options:
     compliance_check:
         description:
             Defines if a compliance check shall be done.
+            It is only done if the subset C(compliance) is selected.
         required: false
         default: true
         type: bool
+    gather_subset:
+        description:
+            Restricts the returned facts to the given subsets and runs only 
+            the queries needed for them.
+            Possible values are C(services), C(versions), C(notes), C(solutions), 
+            C(staging), C(compliance), C(catalog) (the available Notes and
+            Solutions) and C(verify) (the compliance of each applied Note) or C(all).
+            A subset can be excluded by prefixing it with C(!). If only 
+            excluded subsets (or none) are given, they are excluded from
+            the default (all but C(catalog) and C(verify)).
+            If all subsets of the status are selected, the complete status 
+            is returned.
+        required: false
+        default: ['all', '!catalog', '!verify']
+        type: list
+        elements: str
+    verify_workers:
+        description:
+            Maximum number of C(saptune note verify) running in parallel
+            for the subset C(verify).
+        required: false
+        default: 4
+        type: int
+    cache:
+        description:
+            Defines if the status shall be cached on the host in O(cache_dir).
+            A cached status is returned as long as the state token (see
+            RV(saptune_state_token)) has not changed and the cache is not 
+            older than O(cache_max_age). A cached status without compliance
+            check is not used if O(compliance_check) is set.
+        required: false
+        default: true
+        type: bool
+    cache_max_age:
+        description:
+            Maximum age of a cached status in seconds.
+            Changes of the compliance are only detected after that time.
+        required: false
+        default: 3600
+        type: int
+    cache_dir:
+        description:
+            Directory on the host for the cache files.
+        required: false
+        default: /var/cache/ansible_saptune
+        type: path
+    command_timeout:
+        description:
+            Maximum time in seconds a single command may run. If it takes
+            longer, its process group gets terminated and the module fails.
+            C(0) means no limit.
+        required: false
+        default: 600
+        type: int
+    module_timeout:
+        description:
+            Maximum time in seconds for all commands of the module together.
+            No command runs beyond this deadline. C(0) means no limit.
+        required: false
+        default: 0
+        type: int
+    output_capture:
+        description:
+            Defines how much of the stderr of the executed commands is returned in
+            RV(command_output). C(full) keeps all lines, C(truncated) only the first
+            and last O(output_lines) lines and C(summary) only the number of lines.
+            The stdout is parsed by the module and never kept.
+        required: false
+        default: truncated
+        choices: [ full, truncated, summary ]
+        type: str
+    output_lines:
+        description:
+            Number of lines kept from the start and from the end of the output
+            of the stderr of each command if O(output_capture=truncated).
+        required: false
+        default: 10
+        type: int
+    metrics_file:
+        description:
+            If set, the tuning state (applied Notes and Solution, compliance of the tuning and of the
+            verified Notes, service states) and the timings of the run are written atomically to this
+            file for the textfile collector of the Prometheus C(node_exporter).
+            A failure to write the file only results in a warning.
+        required: false
+        type: path
   
 requirements:
     - C(saptune) must support JSON output (>= 3.1)
@@ -44,11 +133,73 @@ EXAMPLES = r'''
   saptune_facts:
     compliance_check: false
 
+# Get the service states and the applied Notes only
+- name: Get saptune services and Notes
+  saptune_facts:
+    gather_subset:
+      - services
+      - notes
+
+# Get everything including the available Notes and Solutions
+- name: Get all saptune facts
+  saptune_facts:
+    gather_subset: all
+
+# Get the compliance of each applied Note
+- name: Verify the applied Notes
+  saptune_facts:
+    gather_subset:
+      - notes
+      - verify
+
+# Get the facts, but never from the cache
+- name: Get fresh saptune facts
+  saptune_facts:
+    cache: false
+
+# Reuse the facts in the saptune module
+- name: Gather saptune facts
+  saptune_facts:
+
+- name: Tune for SAP HANA
+  saptune:
+    apply:
+      - '@HANA'
+    status: '{{ ansible_facts.saptune }}'
+    status_token: '{{ ansible_facts.saptune_state_token }}'
+
 '''
 
 RETURN = r'''
+command_output:
+    description:
+        Exit code and stderr of each command, which wrote to stderr or failed, keyed by the
+        command. How much output is kept depends on O(output_capture).
+    type: dict
+    returned: if a command wrote to stderr or failed
+    sample: '{"saptune --format json status": {"rc": 1, "stderr_lines": ["..."]}}'
+timings:
+    description:
+        Durations in seconds measured with a monotonic clock. C(phases) contains the duration of
+        each executed phase (C(status), C(catalog) and C(verify)), C(commands) the duration of each
+        executed command, C(spawns) the number of started processes and C(total) the duration of
+        the whole run.
+    type: dict
+    returned: always
+    sample: '{
+        "phases": {"status": 0.497},
+        "commands": {"saptune --format json status": 0.495},
+        "spawns": 1,
+        "total": 0.501
+        }'
 saptune:
-    description: The result object of the last C(saptune --format json status).
+    description: 
+        The result object of the last C(saptune --format json status) reduced to the
+        entries of the selected subsets. The subset C(catalog) adds C(Notes available)
+        and C(Solutions available) of C(saptune note list) and C(saptune solution list).
+        The subset C(verify) adds C(Note compliance), which lists for each applied Note
+        if it is compliant and the expected and actual values of the non-compliant 
+        parameters (C(saptune note verify)).
     type: dict
     returned: always
     sample: '{
@@ -83,47 +234,104 @@ saptune:
         "Notes staged": [],
         "Solutions staged": []
         }'
+saptune_state_token:
+    description: 
+        Fingerprint of the host state the status belongs to. It changes if the saptune configuration,
+        saved state or package or the state of C(saptune.service), C(sapconf.service) or C(tuned.service) 
+        changes.
+    type: str
+    returned: always
+    sample: '5d41402abc4b2a76b9719d911017c592...'
+cached:
+    description: Defines if the status has been taken from the cache.
+    type: bool
+    returned: always
+    sample: false
 '''
 
-import collections
 import json
-import subprocess
-from typing import List, Tuple
+import time
+from typing import List, Dict, Any, Set
 from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils import saptune_exec
+from ansible.module_utils.saptune_exec import setup, execute, record_phase
+from ansible.module_utils.saptune_status import status_command, parse_status, get_note_compliance, state_fingerprint, read_cache, write_cache
+
+# The value of the `module` label of the run metrics.
+MODULE_NAME = 'saptune_facts'
+
+# The entries returned for each subset. All but `catalog` are
+# part of 'saptune status'.
+SUBSETS = {
+    'services': ['services', 'systemd system state'],
+    'versions': ['package version', 'configured version', 'virtualization'],
+    'notes': ['Notes enabled by Solution', 'Notes applied by Solution', 'Notes enabled additionally', 'Notes enabled', 'Notes applied'],
+    'solutions': ['Solution enabled', 'Solution applied'],
+    'staging': ['staging'],
+    'compliance': ['tuning state'],
+    'catalog': ['Notes available', 'Solutions available'],
+    'verify': ['Note compliance']
+}
+STATUS_SUBSETS = set(SUBSETS) - {'catalog', 'verify'}
+
 
+def get_subsets(gather_subset: List[str]) -> Set[str]:
+    """Returns the subsets selected by `gather_subset`.
+    Entries can be negated by a leading `!` and `all` selects
+    all subsets. If only negated entries (or none) are given, 
+    they are removed from the default subsets (the ones of the 
+    status), so the expensive `catalog` and `verify` stay opt-in.
+    Calls module.fail_json() in case of an error."""
+
+    subsets = set() if any(entry[:1] != '!' for entry in gather_subset) else set(STATUS_SUBSETS)
+    for entry in gather_subset:
+        name = entry.lstrip('!')
+        if name != 'all' and name not in SUBSETS:
+            module.fail_json(msg=f'''Unknown subset '{name}'! Valid subsets are: all, {', '.join(SUBSETS)}''', **result)
+        selection = set(SUBSETS) if name == 'all' else {name}
+        if entry[:1] == '!':
+            subsets.difference_update(selection)
+        else:
+            subsets.update(selection)
+    return subsets
 
-def execute(command: List[str], ignore_error: bool=False) -> None:
-    """Executes the given command and returns stdout.
-    If ignore_error is set, an exit code not 0 does not lead to a failure.
+def get_status(compliance_check: bool, state_token: str) -> Dict[str, Any]:
+    """Returns 'saptune status'. If `cache` is set, the cached
+    status is returned instead, as long as the state token has
+    not changed and it is not too old. Otherwise the new status 
+    gets cached.
+    Calls module.fail_json() in case of an error."""
+
+    # Return the cached status if the state has not changed since.
+    if module.params['cache']:
+        cache = read_cache('status.json')
+        if cache and cache.get('state token') == state_token and \
+           0 <= time.time() - cache.get('timestamp', 0) <= module.params['cache_max_age'] and \
+           (cache.get('compliance check') or not compliance_check):
+            result['cached'] = True
+            return cache['status']
+
+    # Get saptune status.
+    status = parse_status(execute(status_command(compliance_check), ignore_error=False, capture_stdout=False))
+    
+    # Cache the status for the next time.
+    if module.params['cache'] and not module.check_mode:
+        write_cache('status.json', {'state token': state_token,
+                                    'timestamp': time.time(),
+                                    'compliance check': compliance_check,
+                                    'status': status})
+    return status
+
+def get_list(command: List[str], entry: str) -> List[Dict[str, Any]]:
+    """Returns the given entry of the result object of a 
+    'saptune note list' or 'saptune solution list'.
     Calls module.fail_json() in case of an error."""
 
-    # Set some result entries.
-    for entry, default in ('stdout', ''), ('stdout_lines', []), ('stderr', ''), ('stderr_lines', []):
-        if entry not in result:
-            result[entry] = default
-        
     try:
-        with subprocess.Popen(command,
-                              stdout = subprocess.PIPE, 
-                              stderr = subprocess.PIPE
-                             ) as proc:
-            stdout = proc.stdout.readlines()
-            stderr = proc.stderr.readlines()
-            stdout_str = '\n'.join([line.strip().decode('utf-8') for line in stdout])
-            stderr_str = '\n'.join([line.strip().decode('utf-8') for line in stderr])
-            if stdout:
-                result['stdout'] = result['stdout'] + stdout_str 
-                result['stdout_lines'].append(stdout)
-            if stderr:
-                result['stderr'] = result['stderr'] + stderr_str
-                result['stderr_lines'].append(stderr)
-            result['rc'] = proc.returncode
-        if proc.returncode != 0 and not ignore_error:
-            module.fail_json(msg=f'''Execution of \'{' '.join(command)}\' failed!''', **result)             
-    except Exception as err:
-        module.fail_json(msg=f'''Error executing \'{' '.join(command)}\': {err}''', **result)          
-    return stdout_str
- 
+        return json.loads(execute(command, capture_stdout=False))['result'][entry]
+    except (ValueError, KeyError, TypeError):
+        module.fail_json(msg=f'''No or broken JSON output of \'{' '.join(command)}\'!''', **result)
+
 def run_module():
     
     # We need those objects in all functions.
@@ -132,12 +340,24 @@ def run_module():
     
     # Define module arguments/parameters.
     module_args = dict(
-        compliance_check=dict(type='bool', required=False, default=True)
+        compliance_check=dict(type='bool', required=False, default=True),
+        gather_subset=dict(type='list', elements='str', required=False, default=['all', '!catalog', '!verify']),
+        verify_workers=dict(type='int', required=False, default=4),
+        command_timeout=dict(type='int', required=False, default=600),
+        module_timeout=dict(type='int', required=False, default=0),
+        output_capture=dict(type='str', required=False, default='truncated', choices=['full', 'truncated', 'summary']),
+        output_lines=dict(type='int', required=False, default=10),
+        metrics_file=dict(type='path', required=False),
+        cache=dict(type='bool', required=False, default=True),
+        cache_max_age=dict(type='int', required=False, default=3600),
+        cache_dir=dict(type='path', required=False, default='/var/cache/ansible_saptune')
     )
 
     # Start to build up the result object.
     result = dict(
         changed = False,
+        cached = False,
+        timings = dict(phases = {}, commands = {}, spawns = 0, total = 0)
     )
     
     # Instantiate the Ansible module.
@@ -145,22 +365,57 @@ def run_module():
         argument_spec=module_args,
         supports_check_mode=True
     )
+
+    # Phases and commands are timed from here and no command 
+    # shall run beyond the module deadline.
+    setup(module, result)
     
-    # Get saptune status.
-    command = ['saptune', '--format', 'json', 'status']
-    if not module.params['compliance_check']:
-        command.append('--non-compliance-check')
-    output = execute(command, ignore_error=False)
-    try: 
-        status_output = json.loads(output)
-    except json.decoder.JSONDecodeError:
-        module.fail_json(msg='No or broken JSON output of \'saptune --format json status\'. Is saptune version to old (<3.1) or does not run as root?', **result)
-    if not status_output['result']:
-        module.fail_json(msg='\'saptune --format json status\' returned an empty result!', **result)
-    
+    if module.params['verify_workers'] < 1:
+        module.fail_json(msg='verify_workers must be at least 1!', **result)
+    for name in ('output_lines', 'command_timeout', 'module_timeout'):
+        if module.params[name] < 0:
+            module.fail_json(msg=f'{name} must not be negative!', **result)
+
+    # Determine the subsets and the status entries to return.
+    subsets = get_subsets(module.params['gather_subset'])
+    compliance_check = module.params['compliance_check'] and 'compliance' in subsets
+    facts = {}
+
+    # Get the state token before the status, so it never is newer.
+    state_token = state_fingerprint()
+
+    # Get saptune status, if a subset or the metrics need it. 
+    # The verification needs the applied Notes.
+    if subsets.intersection(STATUS_SUBSETS) or 'verify' in subsets or module.params['metrics_file']:
+        status = get_status(compliance_check, state_token)
+        if subsets.issuperset(STATUS_SUBSETS):
+            facts.update(status)
+        else:
+            for subset in subsets.intersection(STATUS_SUBSETS):
+                facts.update({key: status[key] for key in SUBSETS[subset] if key in status})
+        record_phase('status')
+
+    # Get the Notes and Solutions, if requested.
+    if 'catalog' in subsets:
+        facts['Notes available'] = get_list(['saptune', '--format', 'json', 'note', 'list'], 'Notes available')
+        facts['Solutions available'] = get_list(['saptune', '--format', 'json', 'solution', 'list'], 'Solutions available')
+        record_phase('catalog')
+
+    # Verify each applied Note, if requested.
+    if 'verify' in subsets:
+        facts['Note compliance'] = get_note_compliance(status['Notes applied'])
+        record_phase('verify')
+
+    # Export the tuning state for monitoring.
+    if module.params['metrics_file'] and not module.check_mode:
+        from ansible.module_utils.saptune_metrics import write_metrics
+        write_metrics(MODULE_NAME, status, facts.get('Note compliance'))
+
     # Return with the result.
+    result['timings']['total'] = round(time.monotonic() - saptune_exec.module_start, 3)
     result['rc'] = 0
-    result['ansible_facts'] = { 'saptune': status_output['result']}
+    result['ansible_facts'] = { 'saptune': facts, 
+                                'saptune_state_token': state_token }
     module.exit_json(**result)
 
 
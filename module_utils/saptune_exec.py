@@ -0,0 +1,330 @@
+# -*- coding: utf-8 -*-
+
+# Copyright: (c) 2024, Sören Schmidt <soeren.schmidt@suse.com>
+# GNU General Public License v3.0+ (see LICENSE or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+"""Command execution shared by the `saptune` and `saptune_facts` modules.
+
+setup() has to be called once the AnsibleModule has been created. It 
+stores the module and the result object, which the functions here and
+in the other `saptune_*` module_utils use, and starts the timing of 
+the run. Modules only needed for parallel execution are imported when
+they are used. atomic_write() is shared by everything writing files."""
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import collections
+import os
+import selectors
+import signal
+import subprocess
+import tempfile
+import time
+from typing import List, Dict, Tuple, Any, Callable
+
+# Seconds a terminated command gets before it is killed.
+TERMINATION_GRACE_PERIOD = 5
+
+# Set by setup().
+module = None
+result = None
+deadline = None
+module_start = None
+phase_start = None
+
+
+def setup(ansible_module: Any, module_result: Dict[str, Any]) -> None:
+    """Stores the AnsibleModule and the result object and starts
+    the timing of the run. No command shall run beyond the deadline
+    given by `module_timeout`."""
+
+    global module
+    global result
+    global deadline
+    global module_start
+    global phase_start
+
+    module = ansible_module
+    result = module_result
+    module_start = phase_start = time.monotonic()
+    deadline = module_start + module.params['module_timeout'] if module.params['module_timeout'] else None
+    result.setdefault('timings', dict(phases = {}, commands = {}, spawns = 0, total = 0))
+
+class HandlerFailure(Exception):
+    """Raised by module.fail_json() while a failure handler runs."""
+
+def set_failure_handler(handler: Callable[[str], None]) -> None:
+    """Lets module.fail_json() call the given handler with the
+    message before the module fails, e.g. to roll back changes.
+    The handler is called once at most and without the deadline
+    set by `module_timeout`, only `command_timeout` applies. Inside
+    the handler module.fail_json() raises HandlerFailure instead
+    of ending the module. Whatever the handler adds to `result` 
+    gets returned with the original failure."""
+
+    fail_json = module.fail_json
+
+    def fail_json_in_handler(msg: str, **kwargs: Any) -> None:
+        raise HandlerFailure(msg)
+
+    def fail_json_with_handler(msg: str, **kwargs: Any) -> None:
+        global deadline
+        module.fail_json = fail_json_in_handler
+        deadline = None
+        try:
+            handler(msg)
+        finally:
+            module.fail_json = fail_json
+        fail_json(msg=msg, **dict(kwargs, **result))
+
+    module.fail_json = fail_json_with_handler
+
+class CommandTimeoutError(Exception):
+    """Raised if a command does not finish in time."""
+
+    def __init__(self, timeout: float):
+        super().__init__(f'did not finish within {timeout:.0f} seconds')
+        self.timeout = timeout
+
+class DeadlineExceededError(Exception):
+    """Raised instead of starting a command after the deadline
+    given by `module_timeout` has passed."""
+
+def run_command(command: List[str], timeout: float=None) -> Tuple[int, List[bytes], List[bytes], float]:
+    """Executes the given command and returns the exit code,
+    the lines of stdout and stderr as well as the duration.
+    Both pipes are drained at the same time, so the command
+    cannot block on a full pipe. If the command does not finish
+    within `timeout` seconds, its process group gets terminated
+    and CommandTimeoutError is raised.
+    It does not touch `result` or `module`, so it can be
+    called from multiple threads."""
+
+    start = time.monotonic()
+    end = None if timeout is None else start + timeout
+    with subprocess.Popen(command,
+                          stdout = subprocess.PIPE, 
+                          stderr = subprocess.PIPE,
+                          start_new_session = True
+                         ) as proc:
+        output = {proc.stdout: [], proc.stderr: []}
+        with selectors.DefaultSelector() as selector:
+            for pipe in output:
+                selector.register(pipe, selectors.EVENT_READ)
+            while selector.get_map():
+                remaining = None if end is None else end - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    terminate(proc)
+                    raise CommandTimeoutError(timeout)
+                for key, _ in selector.select(remaining):
+                    chunk = os.read(key.fd, 65536)
+                    if chunk:
+                        output[key.fileobj].append(chunk)
+                    else:
+                        selector.unregister(key.fileobj)
+        try:
+            proc.wait(None if end is None else max(end - time.monotonic(), 0))
+        except subprocess.TimeoutExpired:
+            terminate(proc)
+            raise CommandTimeoutError(timeout)
+    stdout = b''.join(output[proc.stdout]).splitlines(keepends=True)
+    stderr = b''.join(output[proc.stderr]).splitlines(keepends=True)
+    return proc.returncode, stdout, stderr, time.monotonic() - start
+
+def terminate(proc: subprocess.Popen) -> None:
+    """Terminates the process group of the given process.
+    If it is still running after a grace period, it gets killed."""
+
+    for signum in signal.SIGTERM, signal.SIGKILL:
+        try:
+            os.killpg(proc.pid, signum)
+        except ProcessLookupError:
+            return
+        try:
+            proc.wait(TERMINATION_GRACE_PERIOD)
+            return
+        except subprocess.TimeoutExpired:
+            continue
+
+def command_timeout() -> float:
+    """Returns the timeout for a command starting now, which is
+    `command_timeout` limited by the time left until the deadline
+    set by `module_timeout`. None means no timeout.
+    Raises DeadlineExceededError if the deadline has passed."""
+
+    timeouts = []
+    if module.params['command_timeout']:
+        timeouts.append(module.params['command_timeout'])
+    if deadline is not None:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise DeadlineExceededError()
+        timeouts.append(remaining)
+    return min(timeouts) if timeouts else None
+
+def run_command_in_time(command: List[str]) -> Tuple[int, List[bytes], List[bytes], float]:
+    """Executes the given command like run_command() with the
+    timeout determined when it starts (see command_timeout()), so
+    a command waiting for a free worker cannot run past the deadline.
+    Can be called from multiple threads."""
+
+    return run_command(command, command_timeout())
+
+def capture_output(lines: List[bytes]) -> List[str]:
+    """Returns the decoded lines of a command output as they shall
+    be kept in `command_output` according to `output_capture`:
+    all lines (full) or only the first and last `output_lines`
+    lines (truncated)."""
+
+    limit = module.params['output_lines']
+    if module.params['output_capture'] == 'full' or len(lines) <= 2 * limit:
+        return [line.rstrip().decode('utf-8', errors='replace') for line in lines]
+    head = [line.rstrip().decode('utf-8', errors='replace') for line in lines[:limit]]
+    tail = [line.rstrip().decode('utf-8', errors='replace') for line in collections.deque(lines, maxlen=limit)]
+    return head + [f'[... {len(lines) - 2 * limit} lines omitted ...]'] + tail
+
+def record_output(command: List[str], returncode: int, stdout: List[bytes], stderr: List[bytes], capture_stdout: bool) -> None:
+    """Adds the exit code and the output of the given command to
+    `command_output` according to `output_capture`. The stdout of
+    commands whose output gets parsed (`capture_stdout` not set) 
+    is never kept and such commands are only recorded if they wrote
+    to stderr."""
+
+    if not capture_stdout and not stderr:
+        return
+    output = {'rc': returncode}
+    if module.params['output_capture'] == 'summary':
+        if capture_stdout:
+            output['stdout_line_count'] = len(stdout)
+        output['stderr_line_count'] = len(stderr)
+    else:
+        if capture_stdout:
+            output['stdout_lines'] = capture_output(stdout)
+        output['stderr_lines'] = capture_output(stderr)
+
+    result['command_output'][command_key(command, result['command_output'])] = output
+
+def command_key(command: List[str], entries: Dict[str, Any]) -> str:
+    """Returns the key for the given command in `entries`.
+    A command executed multiple times gets a counter."""
+
+    command_str = ' '.join(command)
+    key = command_str
+    count = 1
+    while key in entries:
+        count += 1
+        key = f'{command_str} ({count})'
+    return key
+
+def record_phase(phase: str) -> None:
+    """Adds the time passed since the end of the previous phase
+    (or the start of the module) to the duration of the given
+    phase in `timings` and updates the total."""
+
+    global phase_start
+
+    now = time.monotonic()
+    phases = result['timings']['phases']
+    phases[phase] = round(phases.get(phase, 0) + now - phase_start, 3)
+    result['timings']['total'] = round(now - module_start, 3)
+    phase_start = now
+
+def execute(command: List[str], ignore_error: bool=False, running: 'concurrent.futures.Future'=None, capture_stdout: bool=True) -> str:
+    """Executes the given command and returns stdout.
+    If `running` is given, the command has already been started
+    by execute_concurrently() and only its output gets processed.
+    If ignore_error is set, an exit code not 0 does not lead to a failure.
+    If capture_stdout is not set, stdout is not recorded in
+    `command_output`, because the caller parses it.
+    Calls module.fail_json() in case of an error or timeout."""
+
+    if 'command_output' not in result:
+        result['command_output'] = {}
+        
+    try:
+        result['timings']['spawns'] += 1
+        returncode, stdout, stderr, duration = running.result() if running else run_command_in_time(command)
+        result['timings']['commands'][command_key(command, result['timings']['commands'])] = round(duration, 3)
+        stdout_str = '\n'.join([line.strip().decode('utf-8') for line in stdout])
+        record_output(command, returncode, stdout, stderr, capture_stdout or (returncode != 0 and not ignore_error))
+        result['rc'] = returncode
+    except DeadlineExceededError:
+        result['timings']['spawns'] -= 1     # nothing has been started
+        module.fail_json(msg=f'''Execution of \'{' '.join(command)}\' has not been started, because module_timeout ({module.params['module_timeout']}) has been reached!''', **result)
+    except CommandTimeoutError as err:
+        module.fail_json(msg=f'''Execution of \'{' '.join(command)}\' {err} and has been terminated (command_timeout: {module.params['command_timeout']}, module_timeout: {module.params['module_timeout']})!''', **result)
+    except Exception as err:
+        module.fail_json(msg=f'''Error executing \'{' '.join(command)}\': {err}''', **result)          
+    if returncode != 0 and not ignore_error:
+        module.fail_json(msg=f'''Execution of \'{' '.join(command)}\' failed!''', **result)             
+    return stdout_str
+
+def execute_concurrently(commands: List[Tuple[List[str], bool]], max_workers: int=None, capture_stdout: bool=False) -> List[str]:
+    """Executes the given commands (each with its `ignore_error`
+    flag) in parallel (at most `max_workers` at once) and returns
+    their stdout in the same order.
+    The outputs are processed in the order of the commands, so 
+    `result` is filled the same way as by sequential calls of 
+    execute() and errors are reported for the right command.
+    Because the commands are queries, their stdout is not recorded
+    in `command_output` unless `capture_stdout` is set.
+    Calls module.fail_json() in case of an error or timeout."""
+
+    import concurrent.futures
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers or len(commands)) as pool:
+        running = [pool.submit(run_command_in_time, command) for command, _ in commands]
+    return [execute(command, ignore_error=ignore_error, running=future, capture_stdout=capture_stdout) 
+            for (command, ignore_error), future in zip(commands, running)]
+
+def execute_window(commands: List[List[str]], finished: Callable[[], None]=None) -> None:
+    """Executes the given commands one after the other and records
+    the time from the start of the first to the end of the last one
+    as `untuned_window` in `timings`. If `finished` is given, it is
+    called after each command.
+    Calls module.fail_json() in case of an error or timeout."""
+
+    if not commands:
+        return
+    window_start = time.monotonic()
+    for command in commands:
+        execute(command)
+        if finished:
+            finished()
+    result['timings']['untuned_window'] = round(time.monotonic() - window_start, 3)
+
+def sync_directory(directory: str) -> None:
+    """Syncs the given directory, so a rename or removal inside
+    is on disk."""
+
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def atomic_write(path: str, content: str, mode: int=None, sync: bool=False) -> None:
+    """Writes the content to the given file atomically: to a temporary
+    file in the same directory first, which then replaces the file.
+    Without `mode` the file is only accessible by the owner. If `sync`
+    is set, the file is synced before and the directory after the 
+    rename, so the content is on disk once this returns.
+    Raises OSError in case of an error."""
+
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f'.{os.path.basename(path)}.')
+    try:
+        with os.fdopen(fd, 'w') as tmp_file:
+            tmp_file.write(content)
+            if sync:
+                tmp_file.flush()
+                os.fsync(tmp_file.fileno())
+        if mode is not None:
+            os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+    if sync:
+        sync_directory(directory)
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+# Copyright: (c) 2024, Sören Schmidt <soeren.schmidt@suse.com>
+# GNU General Public License v3.0+ (see LICENSE or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+"""Execution journal of the `saptune` module, so a run interrupted
+while executing its commands can be resumed by the next one. Uses the
+module object stored by saptune_exec.setup().
+
+The journal lives in `cache_dir`. Its first line holds the plan, each
+following line the number of a finished step. Every write is synced
+to disk before the next command runs."""
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import json
+import os
+from typing import Dict, Tuple, Any
+
+from ansible.module_utils import saptune_exec
+
+JOURNAL_NAME = 'journal.jsonl'
+
+# The journal opened by start_journal() for appending the steps.
+journal_file = None
+
+
+def journal_path() -> str:
+    """Returns the path of the journal."""
+
+    return os.path.join(saptune_exec.module.params['cache_dir'], JOURNAL_NAME)
+
+def read_journal() -> Tuple[Dict[str, Any], int]:
+    """Returns the plan of the journal and the number of finished
+    steps or (None, 0), if there is no readable journal. A line cut
+    off by an interruption is ignored."""
+
+    try:
+        with open(journal_path(), 'r') as journal:
+            plan = json.loads(journal.readline())
+            done = 0
+            for line in journal:
+                try:
+                    done = max(done, json.loads(line)['done'])
+                except (ValueError, KeyError, TypeError):
+                    break
+            return plan, done
+    except (OSError, ValueError):
+        return None, 0
+
+def start_journal(plan: Dict[str, Any], done: int=0) -> None:
+    """Writes a new journal with the given plan and, if given, the
+    number of already finished steps. The journal is written 
+    atomically and synced (see saptune_exec.atomic_write()).
+    A failure only results in a warning and no journal."""
+
+    global journal_file
+
+    try:
+        os.makedirs(saptune_exec.module.params['cache_dir'], mode=0o700, exist_ok=True)
+        content = json.dumps(plan) + '\n'
+        if done:
+            content += json.dumps({'done': done}) + '\n'
+        saptune_exec.atomic_write(journal_path(), content, sync=True)
+        journal_file = open(journal_path(), 'a')
+    except (OSError, TypeError, ValueError) as err:
+        saptune_exec.module.warn(f'Could not write journal: {err}')
+
+def record_step(step: int) -> None:
+    """Appends the number of the finished step to the journal and
+    syncs it. A failure only results in a warning and stops the
+    journal."""
+
+    global journal_file
+
+    if journal_file is None:
+        return
+    try:
+        journal_file.write(json.dumps({'done': step}) + '\n')
+        journal_file.flush()
+        os.fsync(journal_file.fileno())
+    except OSError as err:
+        saptune_exec.module.warn(f'Could not write journal: {err}')
+        journal_file.close()
+        journal_file = None
+
+def remove_journal() -> None:
+    """Removes the journal. A failure only results in a warning."""
+
+    global journal_file
+
+    if journal_file is not None:
+        journal_file.close()
+        journal_file = None
+    try:
+        os.unlink(journal_path())
+        saptune_exec.sync_directory(saptune_exec.module.params['cache_dir'])
+    except FileNotFoundError:
+        pass
+    except OSError as err:
+        saptune_exec.module.warn(f'Could not remove journal: {err}')
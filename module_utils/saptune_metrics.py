@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+# Copyright: (c) 2024, Sören Schmidt <soeren.schmidt@suse.com>
+# GNU General Public License v3.0+ (see LICENSE or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+"""Export of the tuning state for the textfile collector of the
+Prometheus `node_exporter`, shared by the `saptune` and `saptune_facts`
+modules. Uses the module and result object stored by saptune_exec.setup()."""
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import time
+from typing import Dict, Any
+
+from ansible.module_utils import saptune_exec
+
+
+def metric_line(name: str, value: float, **labels: str) -> str:
+    """Returns a sample in the text format of the node_exporter
+    textfile collector."""
+
+    escaped = []
+    for label, label_value in labels.items():
+        label_value = str(label_value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        escaped.append(f'{label}="{label_value}"')
+    return f'''{name}{{{','.join(escaped)}}} {value}''' if escaped else f'{name} {value}'
+
+def write_metrics(module_name: str, status: Dict[str, Any], compliance: Dict[str, Dict[str, Any]]=None, changed: bool=False) -> None:
+    """Writes the tuning state of the given status, the compliance
+    of the verified Notes and the timings of the run atomically to
+    `metrics_file` for the node_exporter textfile collector.
+    The timestamp of the last change is kept from the previous
+    file, if nothing has been changed. A failure only results
+    in a warning."""
+
+    path = saptune_exec.module.params['metrics_file']
+    now = time.time()
+
+    # Keep the last change of a previous run.
+    last_change = now if changed else None
+    if last_change is None:
+        try:
+            with open(path, 'r') as metrics_file:
+                for line in metrics_file:
+                    if line.startswith('saptune_last_change_timestamp_seconds '):
+                        last_change = float(line.split()[1])
+        except (OSError, ValueError, IndexError):
+            pass
+
+    # A compliant tuning has only compliant Notes.
+    note_compliance = {note: state['compliant'] for note, state in (compliance or {}).items()}
+    if status.get('tuning state') == 'compliant':
+        note_compliance.update({note: True for note in status['Notes applied']})
+
+    metrics = {
+        'saptune_info': ('gauge', 'Version of saptune.', 
+                         [metric_line('saptune_info', 1, version=status['package version'])]),
+        'saptune_tuning_compliant': ('gauge', 'Compliance of the tuning (1 compliant, 0 not compliant).', 
+                                     [metric_line('saptune_tuning_compliant', int(status['tuning state'] == 'compliant'))]
+                                     if status.get('tuning state') in ('compliant', 'not compliant') else []),
+        'saptune_note_compliant': ('gauge', 'Compliance of a verified Note (1 compliant, 0 not compliant).', 
+                                   [metric_line('saptune_note_compliant', int(compliant), note=note) 
+                                    for note, compliant in sorted(note_compliance.items())]),
+        'saptune_note_applied': ('gauge', 'Applied Note with its position in the order of application.', 
+                                 [metric_line('saptune_note_applied', 1, note=note, position=position) 
+                                  for position, note in enumerate(status['Notes applied'], start=1)]),
+        'saptune_solution_applied': ('gauge', 'Applied Solution.', 
+                                     [metric_line('saptune_solution_applied', 1, solution=solution['Solution ID']) 
+                                      for solution in status['Solution applied']]),
+        'saptune_service_enabled': ('gauge', 'Service is enabled (1) or not (0).', 
+                                    [metric_line('saptune_service_enabled', int(states[0] == 'enabled'), service=f'{service}.service') 
+                                     for service, states in sorted(status['services'].items()) if states]),
+        'saptune_service_active': ('gauge', 'Service is active (1) or not (0).', 
+                                   [metric_line('saptune_service_active', int(states[1] == 'active'), service=f'{service}.service') 
+                                    for service, states in sorted(status['services'].items()) if states]),
+        'saptune_systemd_degraded': ('gauge', 'Systemd system state is degraded (1) or not (0).', 
+                                     [metric_line('saptune_systemd_degraded', int(status.get('systemd system state') == 'degraded'))]),
+        'saptune_staging_enabled': ('gauge', 'Staging is enabled (1) or not (0).', 
+                                    [metric_line('saptune_staging_enabled', int(status['staging']['staging enabled']))]),
+        'saptune_module_phase_duration_seconds': ('gauge', 'Duration of a phase of the last module run.', 
+                                                  [metric_line('saptune_module_phase_duration_seconds', duration, module=module_name, phase=phase) 
+                                                   for phase, duration in saptune_exec.result['timings']['phases'].items()]),
+        'saptune_module_duration_seconds': ('gauge', 'Duration of the last module run.', 
+                                            [metric_line('saptune_module_duration_seconds', round(time.monotonic() - saptune_exec.module_start, 3), module=module_name)]),
+        'saptune_module_untuned_window_seconds': ('gauge', 'Duration of the tuning changes of the last module run, while the system was not tuned as desired.', 
+                                                  [metric_line('saptune_module_untuned_window_seconds', saptune_exec.result['timings']['untuned_window'], module=module_name)]
+                                                  if 'untuned_window' in saptune_exec.result['timings'] else []),
+        'saptune_module_spawns': ('gauge', 'Processes started by the last module run.', 
+                                  [metric_line('saptune_module_spawns', saptune_exec.result['timings']['spawns'], module=module_name)]),
+        'saptune_module_last_run_timestamp_seconds': ('gauge', 'Time of the last module run.', 
+                                                      [metric_line('saptune_module_last_run_timestamp_seconds', round(now, 3), module=module_name)]),
+        'saptune_last_change_timestamp_seconds': ('gauge', 'Time of the last change of the tuning by the module.', 
+                                                  [metric_line('saptune_last_change_timestamp_seconds', round(last_change, 3))] 
+                                                  if last_change is not None else [])
+    }
+    lines = []
+    for name, (metric_type, description, samples) in metrics.items():
+        if samples:
+            lines.extend([f'# HELP {name} {description}', f'# TYPE {name} {metric_type}'] + samples)
+
+    try:
+        saptune_exec.atomic_write(path, '\n'.join(lines) + '\n', mode=0o644)
+    except OSError as err:
+        saptune_exec.module.warn(f'Could not write metrics file \'{path}\': {err}')
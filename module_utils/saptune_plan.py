@@ -0,0 +1,543 @@
+# -*- coding: utf-8 -*-
+
+# Copyright: (c) 2024, Sören Schmidt <soeren.schmidt@suse.com>
+# GNU General Public License v3.0+ (see LICENSE or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+"""Planner for the `saptune` module.
+
+Calculates the tuning (effective Notes and Solution) of an apply list
+and the saptune commands to get there. It neither calls saptune nor
+touches the module, so it can be used on the controller as well,
+e.g. to validate generated apply lists in bulk.
+
+All functions run in linear time of the apply list and the Notes
+involved."""
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+from typing import List, Dict, Tuple, Callable, Iterable
+
+
+class ApplyPlan():
+    """Result of plan_apply().
+
+    notes       Effective Notes (how "applied Notes" should look like).
+    solution    Effective Solution (what "applied Solution" should list) or None.
+    commands    Commands to get there, starting with `saptune revert all`.
+    errors      One dict per invalid entry of the apply list with
+                `index`, `entry` and `msg`. The plan is only usable
+                if it is empty.
+    """
+
+    def __init__(self):
+        self.notes = []
+        self.solution = None
+        self.commands = [['saptune', 'revert', 'all']]
+        self.errors = []
+
+    def __repr__(self):
+        return f'ApplyPlan(notes={self.notes!r}, solution={self.solution!r}, commands={len(self.commands)}, errors={len(self.errors)})'
+
+
+class TuningTracker():
+    """Replays tuning commands the way saptune handles them and
+    keeps track of the effective Notes and Solution.
+
+    The Notes are kept in a dict (insertion ordered), the number of
+    effective Notes of the Solution is counted, so each command
+    costs constant time per Note it touches.
+
+    If `current_notes` is given, the tracker additionally counts in
+    constant time per command if the effective Notes can be reached
+    by reverting Notes of this (current) tuning, see reachable()."""
+
+    def __init__(self, solution_map: Dict[str, List[str]], current_notes: List[str]=None, current_solution: str=None, repair_notes: Iterable[str]=()):
+        self.solution_map = solution_map
+        self.notes = {}
+        self.solution = None
+        self.solution_notes = set()
+        self.solution_count = 0     # effective Notes of the effective Solution
+
+        # Bookkeeping to compare with the current tuning.
+        self.position = {note: index for index, note in enumerate(current_notes or [])}
+        self.current_solution = current_solution
+        self.current_solution_notes = set(solution_map.get(current_solution, [])) if current_solution else set()
+        self.current_solution_count = 0     # effective Notes of the current Solution
+        self.repair_notes = set(repair_notes)
+        self.repair_count = 0       # effective Notes, which have to be repaired
+        self.foreign = 0            # effective Notes, which are not currently applied
+        self.previous = {}          # linked list of the effective Notes, which are
+        self.next = {}              # currently applied, in the order of application
+        self.tail = None
+        self.descents = 0           # neighbours in that list in the wrong order
+
+    def execute(self, command: List[str]) -> None:
+        """Changes the effective Notes and Solution like the given
+        `saptune note apply|revert` or `saptune solution apply`."""
+
+        if command[1:3] == ['solution', 'apply']:
+            self.solution = command[3]
+            self.solution_notes = set(self.solution_map[command[3]])
+            for note in self.solution_map[command[3]]:
+                self.add(note)
+            self.solution_count = sum(1 for note in self.solution_notes if note in self.notes)
+        elif command[1:3] == ['note', 'apply']:
+            self.add(command[3])
+        elif command[1:3] == ['note', 'revert']:
+            self.discard(command[3])
+
+        # If the Notes of a Solution all have been removed, the Solution is removed.
+        if self.solution and not self.solution_count:
+            self.solution = None
+            self.solution_notes = set()
+
+    def add(self, note: str) -> None:
+        """Adds the Note to the end of the effective Notes, if not present."""
+
+        if note in self.notes:
+            return
+        self.notes[note] = None
+        if note in self.solution_notes:
+            self.solution_count += 1
+        if note in self.current_solution_notes:
+            self.current_solution_count += 1
+        if note in self.repair_notes:
+            self.repair_count += 1
+        if note not in self.position:
+            self.foreign += 1
+            return
+        self.previous[note], self.next[note] = self.tail, None
+        if self.tail is not None:
+            self.next[self.tail] = note
+            if self.position[self.tail] > self.position[note]:
+                self.descents += 1
+        self.tail = note
+
+    def discard(self, note: str) -> None:
+        """Removes the Note from the effective Notes, if present."""
+
+        if note not in self.notes:
+            return
+        del self.notes[note]
+        if note in self.solution_notes:
+            self.solution_count -= 1
+        if note in self.current_solution_notes:
+            self.current_solution_count -= 1
+        if note in self.repair_notes:
+            self.repair_count -= 1
+        if note not in self.position:
+            self.foreign -= 1
+            return
+        previous, following = self.previous.pop(note), self.next.pop(note)
+        for left, right in (previous, note), (note, following):
+            if left is not None and right is not None and self.position[left] > self.position[right]:
+                self.descents -= 1
+        if previous is not None and following is not None and self.position[previous] > self.position[following]:
+            self.descents += 1
+        if previous is not None:
+            self.next[previous] = following
+        if following is not None:
+            self.previous[following] = previous
+        else:
+            self.tail = previous
+
+    def reachable(self) -> bool:
+        """Returns if the effective Notes and Solution can be reached
+        by reverting Notes of the current tuning: the effective Notes
+        are all currently applied in the same order, contain no Note
+        to repair and the current Solution survives the reverts (or
+        vanishes) the same way."""
+
+        if self.foreign or self.descents or self.repair_count:
+            return False
+        remaining_solution = self.current_solution if self.current_solution_count else None
+        return remaining_solution == self.solution
+
+
+def plan_apply(apply_list: List[str],
+               existing_notes: Iterable[str],
+               existing_solutions: Iterable[str],
+               solution_map: Dict[str, List[str]]) -> ApplyPlan:
+    """Takes the apply list and calculates the effective Notes
+    (how "applied Notes" should look like) and the effective
+    Solution (what "applied Solution" should list) as well as
+    the commands to achieve it, starting with `saptune revert all`.
+
+    Each invalid entry is reported in `errors` of the returned plan
+    and skipped, so all errors of an apply list are found at once.
+
+    Important:
+    No optimizations are done to remove unnecessary applies or reverts.
+    Some users may create "interesting" apply lists, but adding complex
+    code to mimic saptune behavior for such rare events is too risky.
+    It can introduce bugs and requires adaptation if saptune changes
+    its behavior. In the worst case a version switch might become necessary.
+
+    Nevertheless we track Note apply and removal to calculate the
+    effective Note list as well we check if all Notes of a Solution
+    have been removed to reset the effective Solution. Saptune will
+    do the same."""
+
+    plan = ApplyPlan()
+    existing_notes = existing_notes if isinstance(existing_notes, (set, frozenset, dict)) else set(existing_notes)
+    existing_solutions = existing_solutions if isinstance(existing_solutions, (set, frozenset, dict)) else set(existing_solutions)
+    tracker = TuningTracker(solution_map)
+
+    # Walk through the apply list.
+    for index, original_entry in enumerate(apply_list):
+
+        def error(msg: str) -> None:
+            plan.errors.append({'index': index, 'entry': original_entry, 'msg': msg})
+
+        entry = original_entry
+        if not entry:
+            error('Empty entries are not allowed!')
+            continue
+
+        # A Solution may not have a minus operator.
+        if entry[0:2] == '-@':
+            error(f'Solutions cannot have a minus operator: \'{entry}\'')
+            continue
+
+        # Set operator and remove it from entry.
+        if entry[0] == '-':
+            operator = '-'
+            entry = entry[1:]
+        else:
+            operator = '+'
+
+        # Process the entry.
+        if entry[0:1] == '@':    # Solution
+            entry = entry[1:]
+            if entry not in existing_solutions:
+                error(f'Solution \'{entry}\' is unknown!')
+                continue
+            if tracker.solution:
+                error(f'Only one Solution is allowed!')
+                continue
+            command = ['saptune', 'solution', 'apply', entry]
+        else:   # Note
+            if entry not in existing_notes:
+                error(f'Note \'{entry}\' is unknown!')
+                continue
+            if operator == '+':
+                if entry in tracker.notes:
+                    continue
+                command = ['saptune', 'note', 'apply', entry]
+            else:
+                if entry not in tracker.notes:
+                    continue
+                command = ['saptune', 'note', 'revert', entry]
+        tracker.execute(command)
+        plan.commands.append(command)
+
+    plan.notes = list(tracker.notes)
+    plan.solution = tracker.solution
+    return plan
+
+def plan_costs(commands: List[List[str]],
+               solution_map: Dict[str, List[str]],
+               current_applied_notes: List[str]) -> Tuple[List[int], int]:
+    """Takes the tuning commands of the apply list (without the
+    leading `saptune revert all`) and returns the cost of the
+    commands from each index on and the cost of the full re-apply
+    (reverting the applied Notes and running all commands).
+    Each command costs the number of Notes it reverts or applies."""
+
+    remaining_costs = [0] * (len(commands) + 1)
+    for index in range(len(commands) - 1, -1, -1):
+        command = commands[index]
+        cost = len(solution_map.get(command[3], [])) if command[1:3] == ['solution', 'apply'] else 1
+        remaining_costs[index] = remaining_costs[index + 1] + cost
+    return remaining_costs, len(current_applied_notes) + remaining_costs[0]
+
+def plan_incremental(commands: List[List[str]],
+                     solution_map: Dict[str, List[str]],
+                     current_applied_notes: List[str],
+                     current_applied_solution: str,
+                     repair_notes: Iterable[str]=()) -> List[List[str]]:
+    """Takes the tuning commands of the apply list (without the
+    leading `saptune revert all`) and returns the command list,
+    which gets from the applied Notes and Solution to the same
+    final state by reverting and applying the fewest Notes.
+
+    The idea is simple: if the state after some of the commands
+    can be reached by reverting Notes from the current tuning
+    (the remaining applied Notes keep their order), only those
+    reverts and the rest of the commands are required.
+    If `repair_notes` are given, only states without them are
+    considered, so those Notes get reverted and applied again.
+
+    Returns None, if no command list touches less Notes than the
+    one starting with `saptune revert all`. Saptune removes the Solution
+    if all of its Notes have been reverted. This is considered here
+    as well.
+
+    The commands are replayed once with a TuningTracker, which
+    tells in constant time for each state if it is reachable."""
+
+    remaining_costs, full_cost = plan_costs(commands, solution_map, current_applied_notes)
+
+    # Find the cheapest reachable state (the latest one on a tie).
+    tracker = TuningTracker(solution_map, current_applied_notes, current_applied_solution, repair_notes)
+    best_index, best_cost = None, None
+    for index in range(len(commands) + 1):
+        if index:
+            tracker.execute(commands[index - 1])
+        if tracker.reachable():
+            cost = len(current_applied_notes) - len(tracker.notes) + remaining_costs[index]
+            if best_cost is None or cost <= best_cost:
+                best_index, best_cost = index, cost
+
+    # Fall back to `saptune revert all` if we cannot do better.
+    if best_index is None or best_cost >= full_cost:
+        return None
+
+    # Revert the surplus Notes (last applied first) and apply the rest.
+    tracker = TuningTracker(solution_map)
+    for command in commands[:best_index]:
+        tracker.execute(command)
+    best = [['saptune', 'note', 'revert', note] for note in reversed(current_applied_notes) if note not in tracker.notes]
+    best.extend(commands[best_index:])
+    return best
+
+def plan_repair_candidates(commands: List[List[str]],
+                           solution_map: Dict[str, List[str]],
+                           current_applied_notes: List[str],
+                           current_applied_solution: str) -> List[str]:
+    """Takes the tuning commands of the apply list (without the
+    leading `saptune revert all`) and returns the currently applied
+    Notes, which plan_incremental() could repair for less than a 
+    full re-apply, if only they were non-compliant: the ones missing
+    in at least one cheaper reachable state. Repairing more Notes
+    only leaves fewer states to start from, so if none of them is
+    non-compliant, no repair is cheaper than `saptune revert all`.
+
+    The commands are replayed once, each reachable state costs 
+    linear time of the Notes."""
+
+    remaining_costs, full_cost = plan_costs(commands, solution_map, current_applied_notes)
+
+    # Notes contained in all cheaper reachable states cannot be repaired.
+    tracker = TuningTracker(solution_map, current_applied_notes, current_applied_solution)
+    unrepairable = set(current_applied_notes)
+    for index in range(len(commands) + 1):
+        if index:
+            tracker.execute(commands[index - 1])
+        if tracker.reachable() and len(current_applied_notes) - len(tracker.notes) + remaining_costs[index] < full_cost:
+            unrepairable.intersection_update(tracker.notes)
+    return [note for note in current_applied_notes if note not in unrepairable]
+
+def plan_tuning(plan: ApplyPlan,
+                solution_map: Dict[str, List[str]],
+                current_applied_notes: List[str],
+                current_applied_solution: str,
+                current_enabled_notes: List[str],
+                current_enabled_solution: str,
+                start_sufficient: bool,
+                get_compliance: Callable[[], bool],
+                get_non_compliant_notes: Callable[[List[str]], List[str]],
+                ignore_non_compliant: bool,
+                force_reapply: bool,
+                incremental: bool,
+                reapply: Iterable[str]=()) -> Tuple[List[List[str]], List[str]]:
+    """Takes a valid plan of the apply list and the current tuning
+    and returns the commands to execute and the Notes which get
+    repaired (None if it is no repair).
+
+    If the planned Notes and Solution does not differ
+    from the current ones and the system is compliant or we shall
+    not check for it, an empty command list is returned.
+    The compliance is only requested via `get_compliance()` in
+    this case, because retrieving it is expensive.
+
+    If the tuning matches, but is not compliant and we shall
+    repair it (`get_non_compliant_notes` is given), only the
+    non-compliant Notes (and the ones applied after them) get
+    reverted and applied again. Those Notes are returned as well.
+    `get_non_compliant_notes(notes)` is asked for the repair 
+    candidates (see plan_repair_candidates()) first and only if one
+    of them is non-compliant for the other Notes as well, since
+    otherwise nothing can be saved.
+
+    If `start_sufficient` is set (saptune.service is not running
+    and starting it or keeping it stopped is all the caller wants),
+    nothing is applied and the planned Notes and Solution match
+    the enabled ones, an empty command list is returned as well.
+    The service handling does the rest.
+
+    If there is a difference, a non-comliance we should consider
+    or `force_reapply` is set, the planned commands are returned,
+    starting with a `saptune revert all`.
+
+    If `incremental` is set and the planned Notes and Solution
+    differ from the current ones, plan_incremental() is used to
+    find a shorter command list without `saptune revert all`.
+
+    Applied Notes and Solutions listed in `reapply` (e.g. released
+    from staging with a new definition) always get reverted and 
+    applied again, with plan_incremental() if the tuning matches or
+    `incremental` is set."""
+
+    # The applied Notes which have to be applied again.
+    reapply = set(reapply)
+    outdated_notes = [note for note in current_applied_notes 
+                      if note in reapply or (current_applied_solution in reapply and note in solution_map.get(current_applied_solution, []))]
+
+    # If our calculated configuration is already applied, then no
+    # commands need to be executed except force_reapply is set.
+    if not force_reapply:
+        if plan.solution == current_applied_solution and current_applied_notes == plan.notes:
+
+            # If we have no tuning (no Notes have been selected),
+            # we return with an empty command list.
+            if not current_applied_notes:
+                return [], None
+
+            # Outdated Notes get applied again, the others are kept.
+            if outdated_notes:
+                reapply_commands = plan_incremental(plan.commands[1:],
+                                                    solution_map,
+                                                    current_applied_notes,
+                                                    current_applied_solution,
+                                                    outdated_notes)
+                return (reapply_commands if reapply_commands is not None else plan.commands), None
+
+            # If the tuned system is compliant or we shall ignore
+            # a non-compliance, we return with an empty command list.
+            if ignore_non_compliant or get_compliance():
+                return [], None
+
+            # Re-apply only the non-compliant Notes if we shall repair.
+            if get_non_compliant_notes:
+                candidates = plan_repair_candidates(plan.commands[1:], 
+                                                    solution_map, 
+                                                    current_applied_notes, 
+                                                    current_applied_solution)
+                non_compliant_notes = get_non_compliant_notes(candidates) if candidates else []
+                if non_compliant_notes:
+                    others = [note for note in current_applied_notes if note not in candidates]
+                    non_compliant_notes.extend(get_non_compliant_notes(others) if others else [])
+                    repair_commands = plan_incremental(plan.commands[1:],
+                                                       solution_map,
+                                                       current_applied_notes,
+                                                       current_applied_solution,
+                                                       non_compliant_notes)
+                    if repair_commands is not None:
+                        reverted = {command[3] for command in repair_commands if command[1:3] == ['note', 'revert']}
+                        return repair_commands, [note for note in plan.notes if note in reverted]
+
+        # If nothing is applied, because saptune.service has not been
+        # started, but the enabled Notes and Solution already match,
+        # no tuning commands are required.
+        if start_sufficient and not current_applied_notes and not current_applied_solution:
+            if plan.solution == current_enabled_solution and current_enabled_notes == plan.notes:
+                return [], None
+
+    # If the calculated configuration differs from the applied one,
+    # we try to get there without reverting everything.
+    if incremental:
+        if plan.solution != current_applied_solution or current_applied_notes != plan.notes:
+            incremental_commands = plan_incremental(plan.commands[1:],
+                                                    solution_map,
+                                                    current_applied_notes,
+                                                    current_applied_solution,
+                                                    outdated_notes)
+            if incremental_commands is not None:
+                return incremental_commands, None
+
+    return plan.commands, None
+
+def plan_restore(notes: List[str], solution: str, solution_map: Dict[str, List[str]]) -> ApplyPlan:
+    """Returns the plan to get back to the given tuning (Notes in
+    the order of their application and Solution), e.g. one recorded
+    before a change.
+
+    The Solution is applied at the position of its first Note, all
+    other Notes one by one and Notes of the Solution, which are
+    missing, get reverted at the end. If the Notes of the Solution
+    have not been applied in one go, the order of the effective
+    Notes can differ from the given one."""
+
+    solution_notes = solution_map.get(solution, []) if solution else []
+    solution_note_set = set(solution_notes)
+    note_set = set(notes)
+    apply_list = []
+    solution_added = False
+    for note in notes:
+        if note not in solution_note_set:
+            apply_list.append(note)
+        elif not solution_added:
+            apply_list.append(f'@{solution}')
+            solution_added = True
+    if solution_added:
+        apply_list.extend(f'-{note}' for note in solution_notes if note not in note_set)
+    return plan_apply(apply_list, note_set | solution_note_set, [solution] if solution else [], solution_map)
+
+def plan_expected_tunings(commands: List[List[str]],
+                          solution_map: Dict[str, List[str]],
+                          applied_notes: List[str],
+                          applied_solution: str,
+                          enabled_notes: List[str],
+                          enabled_solution: str) -> List[Tuple[List[str], str]]:
+    """Returns the applied Notes and Solution expected after each of
+    the given commands, starting with the given applied and enabled
+    tuning.
+
+    Tuning commands change the applied and the enabled tuning alike.
+    Starting saptune.service applies the enabled tuning, stopping it
+    reverts the applied one. All other commands leave the tuning 
+    alone."""
+
+    def tracker_of(notes: List[str], solution: str) -> TuningTracker:
+        tracker = TuningTracker(solution_map)
+        for note in notes:
+            tracker.add(note)
+        if solution:
+            tracker.solution = solution
+            tracker.solution_notes = set(solution_map.get(solution, []))
+            tracker.solution_count = sum(1 for note in tracker.solution_notes if note in tracker.notes)
+        return tracker
+
+    applied = tracker_of(applied_notes, applied_solution)
+    enabled = tracker_of(enabled_notes, enabled_solution)
+    expected = []
+    for command in commands:
+        if command[:3] == ['saptune', 'revert', 'all']:
+            applied, enabled = tracker_of([], None), tracker_of([], None)
+        elif command[0] == 'saptune' and command[1] in ('note', 'solution'):
+            applied.execute(command)
+            enabled.execute(command)
+        elif command[0] == 'systemctl' and 'saptune.service' in command:
+            if command[1] == 'start' or command[1:3] == ['enable', '--now']:
+                applied = tracker_of(list(enabled.notes), enabled.solution)
+            elif command[1] == 'stop' or command[1:3] == ['disable', '--now']:
+                applied = tracker_of([], None)
+        expected.append((list(applied.notes), applied.solution))
+    return expected
+
+def plan_changed_notes(tunings: List[Tuple[List[str], str]]) -> List[str]:
+    """Takes the applied Notes and Solution before and after each
+    command (see plan_expected_tunings()) and returns the Notes of
+    the last tuning, whose values may have been changed by the
+    commands: the ones which got applied and the ones applied after
+    a Note which got reverted, because reverting restores the values
+    from before the reverted Note, which can include parameters
+    shared with Notes applied later. All other Notes keep their 
+    values.
+
+    Each command costs linear time of the Notes before and after it."""
+
+    changed = set()
+    for (before, _), (after, _) in zip(tunings, tunings[1:]):
+        after_set = set(after)
+        reverted = False
+        for note in before:
+            if note not in after_set:
+                reverted = True
+            elif reverted:
+                changed.add(note)
+        before_set = set(before)
+        changed.update(note for note in after if note not in before_set)
+    return [note for note in tunings[-1][0] if note in changed] if tunings else []
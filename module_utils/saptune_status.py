@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+# Copyright: (c) 2024, Sören Schmidt <soeren.schmidt@suse.com>
+# GNU General Public License v3.0+ (see LICENSE or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+"""Status retrieval and parsing shared by the `saptune` and
+`saptune_facts` modules. Uses the module and result object stored
+by saptune_exec.setup()."""
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import hashlib
+import json
+import os
+from typing import List, Dict, Any
+
+from ansible.module_utils import saptune_exec
+from ansible.module_utils.saptune_exec import execute_concurrently, atomic_write
+
+# The files and directories as well as the systemd units
+# which reflect the state reported by 'saptune status'.
+STATE_PATHS = ['/etc/sysconfig/saptune', '/etc/saptune', '/var/lib/saptune', '/run/saptune', '/usr/sbin/saptune']
+STATE_UNITS = ['saptune.service', 'sapconf.service', 'tuned.service']
+
+
+def status_command(compliance_check: bool=True) -> List[str]:
+    """Returns the command for 'saptune status'."""
+
+    command = ['saptune', '--format', 'json', 'status']
+    if not compliance_check:
+        command.append('--non-compliance-check')
+    return command
+
+def parse_status(output: str) -> Dict[str, Any]:
+    """Returns the result object of the output of 'saptune status'.
+    Calls module.fail_json() in case of an error."""
+
+    try: 
+        json_output = json.loads(output)
+    except json.decoder.JSONDecodeError:
+        saptune_exec.module.fail_json(msg='No or broken JSON output of \'saptune --format json status\'. Is saptune version to old (<3.1) or does not run as root?', **saptune_exec.result)
+    if not json_output['result']:
+        saptune_exec.module.fail_json(msg='\'saptune --format json status\' returned an empty result!', **saptune_exec.result)
+    return json_output['result']
+
+def get_note_compliance(notes: List[str]) -> Dict[str, Dict[str, Any]]:
+    """Runs 'saptune note verify' for the given Notes in parallel
+    (at most `verify_workers` at once) and returns a compact
+    compliance table: for each Note if it is compliant and the 
+    expected and actual value of each non-compliant parameter.
+    Calls module.fail_json() in case of an error."""
+
+    # A non-compliant Note results in an exit code not 0.
+    commands = [(['saptune', '--format', 'json', 'note', 'verify', note], True) for note in notes]
+    outputs = execute_concurrently(commands, max_workers=saptune_exec.module.params['verify_workers']) if commands else []
+
+    compliance = {}
+    for note, (command, _), output in zip(notes, commands, outputs):
+        try:
+            verifications = json.loads(output)['result']['verifications']
+        except (ValueError, KeyError, TypeError):
+            saptune_exec.module.fail_json(msg=f'''No or broken JSON output of \'{' '.join(command)}\'!''', **saptune_exec.result)
+        deviations = {entry['parameter']: {'expected': entry.get('expected value'), 'actual': entry.get('actual value')}
+                      for entry in verifications if entry.get('compliant') is False}
+        compliance[note] = {'compliant': not deviations, 'non-compliant parameters': deviations}
+    return compliance
+
+def state_fingerprint() -> str:
+    """Returns a hash over the modification times, sizes and
+    link targets of the files and directories which reflect the
+    state reported by 'saptune status' (configuration, saved 
+    state, package and systemd units)."""
+
+    digest = hashlib.sha256()
+    paths = STATE_PATHS + [f'/etc/systemd/system/multi-user.target.wants/{unit}' for unit in STATE_UNITS] + \
+                          [f'/run/systemd/units/invocation:{unit}' for unit in STATE_UNITS]
+    for path in paths:
+        for root, dirs, files in os.walk(path) if os.path.isdir(path) else [(path, [], [])]:
+            dirs.sort()
+            for entry in [root] + [os.path.join(root, name) for name in sorted(files)]:
+                try:
+                    stat = os.lstat(entry)
+                    target = os.readlink(entry) if os.path.islink(entry) else ''
+                except OSError:
+                    digest.update(f'{entry} -\n'.encode('utf-8'))
+                    continue
+                digest.update(f'{entry} {stat.st_mtime_ns} {stat.st_size} {target}\n'.encode('utf-8'))
+    return digest.hexdigest()
+
+def read_cache(name: str) -> Dict[str, Any]:
+    """Returns the content of the given cache file in `cache_dir`
+    or None, if it does not exist or cannot be read."""
+
+    try:
+        with open(os.path.join(saptune_exec.module.params['cache_dir'], name), 'r') as cache_file:
+            return json.load(cache_file)
+    except (OSError, ValueError):
+        return None
+
+def write_cache(name: str, content: Dict[str, Any]) -> None:
+    """Writes the content atomically to the given cache file
+    in `cache_dir`. A failure only results in a warning."""
+
+    try:
+        os.makedirs(saptune_exec.module.params['cache_dir'], mode=0o700, exist_ok=True)
+        atomic_write(os.path.join(saptune_exec.module.params['cache_dir'], name), json.dumps(content))
+    except (OSError, TypeError, ValueError) as err:
+        saptune_exec.module.warn(f'Could not write cache file \'{name}\': {err}')
@@ -0,0 +1,57 @@
+"""Tests of the apply planner (module_utils/saptune_plan.py).
+
+    python3 -m pytest tests
+"""
+
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'module_utils'))
+from saptune_plan import plan_apply, plan_incremental, plan_restore, plan_expected_tunings, plan_changed_notes
+
+NOTES = [f'N{index}' for index in range(12)]
+SOLUTION_MAP = {'S1': ['N0', 'N1', 'N2'], 'S2': ['N2', 'N3']}
+
+
+def random_plan(rng: random.Random):
+    """Returns the plan of a random valid apply list."""
+
+    apply_list = [f'@{rng.choice(list(SOLUTION_MAP))}'] if rng.random() < 0.5 else []
+    apply_list.extend(rng.sample(NOTES, rng.randint(0, 6)))
+    if len(apply_list) > 1 and rng.random() < 0.3:
+        apply_list.append(f'-{apply_list[-1]}')
+    plan = plan_apply(apply_list, NOTES, list(SOLUTION_MAP), SOLUTION_MAP)
+    assert not plan.errors
+    return plan
+
+
+def test_incremental_reaches_plan():
+    rng = random.Random(4711)
+    planned = 0
+    for _ in range(2000):
+        current, target = random_plan(rng), random_plan(rng)
+        repair = rng.sample(current.notes, min(len(current.notes), rng.randint(0, 1)))
+        commands = plan_incremental(target.commands[1:], SOLUTION_MAP, current.notes, current.solution, repair)
+        if commands is None:
+            continue
+        assert not [command for command in commands if command[1] == 'revert' and command[2] == 'all']
+        tunings = [(current.notes, current.solution)]
+        tunings.extend(plan_expected_tunings(commands, SOLUTION_MAP, current.notes, current.solution, current.notes, current.solution))
+        assert tunings[-1] == (target.notes, target.solution)
+        assert all(any(note not in notes for notes, _ in tunings) for note in repair)
+        planned += 1
+    assert planned > 100
+
+
+def test_restore():
+    plan = plan_restore(['N5', 'N0', 'N1', 'N6'], 'S1', SOLUTION_MAP)
+    assert plan.commands[1:] == [['saptune', 'note', 'apply', 'N5'], ['saptune', 'solution', 'apply', 'S1'],
+                                 ['saptune', 'note', 'apply', 'N6'], ['saptune', 'note', 'revert', 'N2']]
+    assert (plan.notes, plan.solution) == (['N5', 'N0', 'N1', 'N6'], 'S1')
+
+
+def test_changed_notes():
+    tunings = [(['N0', 'N1', 'N2'], None), (['N0', 'N2'], None), (['N0', 'N2', 'N4'], None)]
+    assert plan_changed_notes(tunings) == ['N2', 'N4']
+    assert plan_changed_notes(tunings[:1]) == []